@@ -0,0 +1,205 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import queue
+import time
+import numpy as np
+from dqn_model import Transition
+from main import train_on_minibatch
+
+
+class ParameterBroadcast:
+    '''
+    Weights of a network in shared memory, published by the learner and picked up by the actors.
+    The version counter is odd while a publish is in progress, a reader that sees it change during
+    its copy retries, so actors never load half-written weights and the learner never waits for them.
+    '''
+
+    def __init__(self, weights):
+        '''
+        :param weights: list of arrays, e.g. DoubleQLearningModel.get_weights()
+        '''
+        self._shapes = [np.shape(w) for w in weights]
+        size = sum(int(np.prod(shape)) for shape in self._shapes)
+        self._shm = shared_memory.SharedMemory(create=True, size=8 + 4 * size)
+        self._owner = True
+        self._attach()
+        self._version[0] = 0
+        self.publish(weights)
+
+    def _attach(self):
+        size = sum(int(np.prod(shape)) for shape in self._shapes)
+        self._version = np.ndarray((1,), dtype=np.int64, buffer=self._shm.buf)
+        self._flat = np.ndarray((size,), dtype=np.float32, buffer=self._shm.buf, offset=8)
+
+    def __getstate__(self):
+        return {'name': self._shm.name, 'shapes': self._shapes}
+
+    def __setstate__(self, state):
+        self._shapes = state['shapes']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._attach()
+
+    @property
+    def version(self):
+        return int(self._version[0])
+
+    def publish(self, weights):
+        self._version[0] += 1
+        np.concatenate([np.ravel(w) for w in weights], out=self._flat)
+        self._version[0] += 1
+
+    def poll(self, version):
+        '''
+        :param version: version the caller already has
+        :return: (version, weights), weights is None if nothing newer was published
+        '''
+        while True:
+            current = int(self._version[0])
+            if current == version:
+                return version, None
+            if current % 2:
+                time.sleep(0)
+                continue
+            flat = self._flat.copy()
+            if int(self._version[0]) == current:
+                break
+        weights = []
+        offset = 0
+        for shape in self._shapes:
+            size = int(np.prod(shape))
+            weights.append(flat[offset:offset + size].reshape(shape))
+            offset += size
+        return current, weights
+
+    def close(self):
+        del self._version, self._flat
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def run_actor(index, env_fn, model_fn, replay_buffer, parameters, episodes, stop, eps=.1, sync_every=100,
+              max_steps=200, preprocess=None, seed=None):
+    '''
+    Acts in one environment with a local copy of the online network until stop is set
+    : param index: actor number, reported with every finished episode
+    : param env_fn: picklable callable that creates the environment
+    : param model_fn: picklable callable that creates a DoubleQLearningModel like the learner's
+    : param replay_buffer: SharedExperienceReplay the transitions are added to
+    : param parameters: ParameterBroadcast the weights are read from
+    : param episodes: queue that gets (index, reward, steps) of every finished episode
+    : param stop: event that ends the actor
+    : param eps: fixed exploration rate of this actor
+    : param sync_every: steps between checks for new weights
+    '''
+    import tensorflow as tf
+    # one thread per actor, the learner gets the rest of the machine
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    np.random.seed(seed)
+    if preprocess is None:
+        preprocess = lambda observation: observation / 2
+    env = env_fn()
+    model = model_fn()
+    version = 0
+    total_steps = 0
+    try:
+        while not stop.is_set():
+            state = preprocess(env.reset())[np.newaxis]
+            terminal = False
+            ep_reward = 0
+            steps = 0
+            while not terminal and steps < max_steps and not stop.is_set():
+                if total_steps % sync_every == 0:
+                    version, weights = parameters.poll(version)
+                    if weights is not None:
+                        model.set_weights(weights)
+                action = model.act(state, eps)
+                new_state, reward, terminal, _ = env.step(action)
+                new_state = preprocess(new_state)[np.newaxis]
+                steps += 1
+                total_steps += 1
+                # as in train_loop_ddqn, reaching the maximum amount of steps is not a terminal for training
+                t_to_buffer = terminal if not steps == max_steps else False
+                replay_buffer.add(Transition(s=state, a=action, r=reward, next_s=new_state, t=t_to_buffer))
+                state = new_state
+                ep_reward += reward
+            episodes.put((index, ep_reward, steps))
+    finally:
+        parameters.close()
+        replay_buffer.close()
+
+
+def train_actor_learner(model, env_fn, model_fn, replay_buffer, num_actors, num_updates, batch_size=128, gamma=.94,
+                        warmup=1000, broadcast_every=100, epsilons=None, max_steps=200, preprocess=None,
+                        context='spawn'):
+    '''
+    Trains the model with actors that act in their own processes while this process only learns.
+    The actors add their transitions to the shared replay buffer, the learner samples minibatches
+    from it continuously and publishes the online weights every broadcast_every updates.
+    : param model: DoubleQLearningModel that is trained
+    : param env_fn: picklable callable that creates an environment, e.g. functools.partial(Room, headless=True)
+    : param model_fn: picklable callable that creates the actors' models, e.g.
+        functools.partial(DoubleQLearningModel, state_dim=obs_dim, action_dim=num_actions, learning_rate=1e-4)
+    : param replay_buffer: SharedExperienceReplay
+    : param num_updates: number of update steps of the learner
+    : param warmup: transitions in the buffer before the learner starts
+    : param epsilons: exploration rate per actor, by default spread from .4 down to .4 ** 8 as in Ape-X
+    : return: episodic rewards and their running average, in the order the episodes finished
+    '''
+    ctx = mp.get_context(context)
+    if epsilons is None:
+        epsilons = [.4 ** (1 + 7. * i / max(num_actors - 1, 1)) for i in range(num_actors)]
+    parameters = ParameterBroadcast(model.get_weights())
+    episodes = ctx.Queue()
+    stop = ctx.Event()
+    actors = [ctx.Process(target=run_actor, daemon=True,
+                          args=(i, env_fn, model_fn, replay_buffer, parameters, episodes, stop, epsilons[i]),
+                          kwargs={'max_steps': max_steps, 'preprocess': preprocess,
+                                  'seed': np.random.randint(2 ** 31)})
+              for i in range(num_actors)]
+    for actor in actors:
+        actor.start()
+
+    R_buffer = []
+    R_avg = []
+
+    def collect_episodes():
+        while True:
+            try:
+                index, ep_reward, steps = episodes.get_nowait()
+            except queue.Empty:
+                return False
+            i = len(R_buffer)
+            R_buffer.append(ep_reward)
+            R_avg.append(.05 * R_buffer[i] + .95 * R_avg[i - 1]) if i > 0 else R_avg.append(R_buffer[i])
+            print('Episode: ', i, 'Actor:', index, 'Reward:', ep_reward, 'Steps:', steps)
+            # if running average > 195, the task is considerd solved
+            if R_avg[-1] > 195:
+                return True
+
+    try:
+        updates = 0
+        while updates < num_updates:
+            if collect_episodes():
+                break
+            if replay_buffer.buffer_length <= warmup:
+                time.sleep(.01)
+                continue
+            train_on_minibatch(model, replay_buffer, batch_size, gamma)
+            updates += 1
+            if updates % broadcast_every == 0:
+                parameters.publish(model.get_weights())
+    finally:
+        stop.set()
+        # keep draining, actors that still have episodes in the queue cannot exit before they are read
+        while any(actor.is_alive() for actor in actors):
+            try:
+                episodes.get(timeout=.1)
+            except queue.Empty:
+                pass
+        for actor in actors:
+            actor.join()
+        parameters.close()
+    return R_buffer, R_avg
@@ -0,0 +1,260 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+# run without a window unless a video driver is picked explicitly
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+from dqn_model import Transition
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    import tensorflow as tf
+    tf.random.set_seed(seed)
+
+
+def measure(fn, repeat=5, min_time=.2):
+    '''
+    Times a function like timeit: the number of calls per run is raised until a run takes min_time
+    :param fn: function without arguments
+    :param repeat: number of runs
+    :return: dict with the best and median seconds per call and calls per second of the best run
+    '''
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+    runs = [elapsed / number] + [t / number for t in timer.repeat(repeat - 1, number)]
+    return {'best_s': min(runs), 'median_s': float(np.median(runs)), 'per_s': 1. / min(runs),
+            'number': number, 'repeat': repeat}
+
+
+def bench_room_step(repeat, seed):
+    '''
+    Room.step with each renderer and collision test. The last variant observes the state vector and never
+    draws a frame, so it measures the dynamics without rendering.
+    '''
+    from room import Room
+    results = []
+    for params in [{'renderer': 'pygame'},
+                   {'renderer': 'pygame', 'headless': True},
+                   {'renderer': 'numpy', 'headless': True},
+                   {'renderer': 'numpy', 'headless': True, 'collision': 'analytic'},
+                   {'renderer': 'numpy', 'headless': True, 'collision': 'analytic', 'observation': 'state'}]:
+        env = Room(seed=seed, **params)
+        env.reset()
+        actions = np.random.randint(env.action_space.n, size=1024)
+        step = [0]
+
+        def fn():
+            step[0] += 1
+            _, _, terminal, _ = env.step(actions[step[0] % len(actions)])
+            if terminal:
+                env.reset()
+
+        results.append(('room.step', params, measure(fn, repeat)))
+    return results
+
+
+def bench_environment_step(repeat, seed):
+    from environment import Environment
+    env = Environment(20, 600, 360, seed=seed)
+    env.reset()
+    actions = np.random.randint(env.action_space.n, size=1024)
+    step = [0]
+
+    def fn():
+        step[0] += 1
+        env.step(actions[step[0] % len(actions)])
+
+    # the environment prints whenever the desired room changes
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [('environment.step', {}, measure(fn, repeat))]
+
+
+def bench_replay(repeat, state_shape, capacity, batch_sizes):
+    from dqn_model import ExperienceReplay, ArrayExperienceReplay, PrioritizedExperienceReplay
+    results = []
+    # a few distinct states are enough, the buffers copy or reference them all the same
+    states = [np.random.uniform(size=(1,) + state_shape).astype(np.float32) for _ in range(8)]
+    transitions = [Transition(s=states[i], a=i % 6, r=-1., next_s=states[(i + 1) % 8], t=False) for i in range(8)]
+    for cls in [ExperienceReplay, ArrayExperienceReplay, PrioritizedExperienceReplay]:
+        name = cls.__name__
+        for fill in [.1, .5, 1.]:
+            replay_buffer = cls(buffer_size=capacity, state_size=state_shape)
+            for i in range(max(int(fill * capacity), max(batch_sizes))):
+                replay_buffer.add(transitions[i % 8])
+            for batch_size in batch_sizes:
+                results.append(('replay.sample_minibatch', {'buffer': name, 'fill': fill, 'batch_size': batch_size},
+                                measure(lambda: replay_buffer.sample_minibatch(batch_size), repeat)))
+        # the full buffer from the last fill level, adds wrap around from here on
+        step = [0]
+
+        def add():
+            step[0] += 1
+            replay_buffer.add(transitions[step[0] % 8])
+
+        results.append(('replay.add', {'buffer': name}, measure(add, repeat)))
+    return results
+
+
+def bench_td_targets(repeat, batch_sizes, num_actions=6):
+    from main import calculate_td_targets
+    results = []
+    for batch_size in batch_sizes:
+        q1 = np.random.normal(size=(batch_size, num_actions)).astype(np.float32)
+        q2 = np.random.normal(size=(batch_size, num_actions)).astype(np.float32)
+        r = np.random.normal(size=(batch_size, 1))
+        t = np.random.uniform(size=(batch_size, 1)) < .1
+        results.append(('calculate_td_targets', {'batch_size': batch_size},
+                        measure(lambda: calculate_td_targets(q1, q2, r, t, .94), repeat)))
+    return results
+
+
+def bench_model(repeat, state_shape, batch_sizes, num_actions=6):
+    from dqn_model import DoubleQLearningModel
+    model = DoubleQLearningModel(state_dim=state_shape, action_dim=num_actions, learning_rate=1e-4)
+    results = []
+    state = np.random.uniform(size=(1,) + state_shape).astype(np.float32)
+    results.append(('model.get_q_values', {'state_shape': list(state_shape), 'batch_size': 1},
+                    measure(lambda: model.get_q_values(state), repeat)))
+    for batch_size in batch_sizes:
+        states = np.random.uniform(size=(batch_size,) + state_shape).astype(np.float32)
+        targets = np.random.normal(size=(batch_size, 1))
+        actions = np.random.randint(num_actions, size=(batch_size, 1))
+        params = {'state_shape': list(state_shape), 'batch_size': batch_size}
+        results.append(('model.get_q_values', params, measure(lambda: model.get_q_values(states), repeat)))
+        results.append(('model.get_q_values_for_both_models', params,
+                        measure(lambda: model.get_q_values_for_both_models(states), repeat)))
+        results.append(('model.update', params, measure(lambda: model.update(states, targets, actions), repeat)))
+    return results
+
+
+def bench_train_loop(seed, steps, batch_size):
+    '''
+    Runs train_loop_ddqn on a headless Room with 84x84 frames for a fixed number of environment steps.
+    The first 1000 steps only fill the replay buffer, as in training.
+    '''
+    import main
+    from dqn_model import DoubleQLearningModel, ArrayExperienceReplay
+    from preprocessing import FramePreprocessor
+    from room import Room
+    seed_everything(seed)
+    env = Room(headless=True, renderer='numpy', collision='analytic', seed=seed)
+    preprocess = FramePreprocessor(output_size=(84, 84))
+    model = DoubleQLearningModel(state_dim=preprocess.output_shape, action_dim=env.action_space.n,
+                                 learning_rate=1e-4, input_scale=preprocess.scale)
+    # train_loop_ddqn reads these globals of main
+    main.num_actions = env.action_space.n
+    main.replay_buffer = ArrayExperienceReplay(buffer_size=max(steps, 1), state_size=preprocess.output_shape)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.train_loop_ddqn(model, env, sys.maxsize, batch_size, preprocess=preprocess, step_budget=steps)
+    elapsed = time.perf_counter() - start
+    return [('train_loop_ddqn', {'seed': seed, 'steps': steps, 'batch_size': batch_size},
+             {'seconds': elapsed, 'fps': steps / elapsed})]
+
+
+def environment_info():
+    info = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__}
+    try:
+        import tensorflow as tf
+        info['tensorflow'] = tf.__version__
+    except ImportError:
+        pass
+    try:
+        info['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                                 cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def compare(previous, current, tolerance=.1):
+    '''
+    Finds benchmarks that got slower between two result files
+    :param previous: results loaded from an earlier run
+    :param current: results of this run
+    :param tolerance: allowed relative slowdown
+    :return: list of (name, params, previous seconds, current seconds) of the regressions
+    '''
+    def seconds(result):
+        return result['stats']['best_s'] if 'best_s' in result['stats'] else 1. / result['stats']['fps']
+
+    before = {(r['name'], json.dumps(r['params'], sort_keys=True)): seconds(r) for r in previous['results']}
+    regressions = []
+    for result in current['results']:
+        key = (result['name'], json.dumps(result['params'], sort_keys=True))
+        if key in before and seconds(result) > before[key] * (1 + tolerance):
+            regressions.append((result['name'], result['params'], before[key], seconds(result)))
+    return regressions
+
+
+def run(groups, repeat=5, seed=0, state_shape=(84, 84, 1), replay_size=5000, batch_sizes=(32, 128),
+        train_steps=2000):
+    '''
+    Runs the selected benchmark groups
+    :param groups: names out of 'room', 'environment', 'replay', 'td_targets', 'model', 'train_loop'
+    :return: dict with the environment info and a list of results
+    '''
+    seed_everything(seed)
+    benchmarks = {
+        'room': lambda: bench_room_step(repeat, seed),
+        'environment': lambda: bench_environment_step(repeat, seed),
+        'replay': lambda: bench_replay(repeat, state_shape, replay_size, batch_sizes),
+        'td_targets': lambda: bench_td_targets(repeat, batch_sizes + (512,)),
+        'model': lambda: bench_model(repeat, state_shape, batch_sizes),
+        'train_loop': lambda: bench_train_loop(seed, train_steps, batch_sizes[-1]),
+    }
+    results = []
+    for group in groups:
+        for name, params, stats in benchmarks[group]():
+            results.append({'name': name, 'params': params, 'stats': stats})
+            rate = stats['per_s'] if 'per_s' in stats else stats['fps']
+            print('%-36s %-70s %12.1f /s' % (name, json.dumps(params), rate))
+    return {'environment': environment_info(), 'results': results}
+
+
+if __name__ == "__main__":
+    groups = ['room', 'environment', 'replay', 'td_targets', 'model', 'train_loop']
+    parser = argparse.ArgumentParser(description='Throughput benchmarks of the environments, replay buffers and model')
+    parser.add_argument('groups', nargs='*', default=groups, help='any of %s, all by default' % ', '.join(groups))
+    parser.add_argument('--output', default='benchmark.json', help='file the results are written to')
+    parser.add_argument('--compare', help='results of an earlier run, exits with 1 if anything got slower')
+    parser.add_argument('--tolerance', type=float, default=.1, help='allowed relative slowdown for --compare')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--state-shape', default='84,84,1', help='state shape of the replay and model benchmarks')
+    parser.add_argument('--replay-size', type=int, default=5000)
+    parser.add_argument('--train-steps', type=int, default=2000)
+    args = parser.parse_args()
+    if any(group not in groups for group in args.groups):
+        parser.error('unknown benchmark group in %s' % ', '.join(args.groups))
+
+    results = run(args.groups, args.repeat, args.seed, tuple(int(n) for n in args.state_shape.split(',')),
+                  args.replay_size, train_steps=args.train_steps)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for name, params, before, after in regressions:
+            print('Slower: %s %s %.3g s -> %.3g s' % (name, json.dumps(params), before, after))
+        sys.exit(1 if regressions else 0)
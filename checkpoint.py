@@ -0,0 +1,187 @@
+import json
+import os
+import pickle
+import random
+import numpy as np
+
+
+def _sync(f):
+    # the files of a checkpoint have to be on disk before the manifest names them
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _generators(env):
+    '''
+    :return: the environment's own random generators: np_random and random of seeded rooms and grid worlds,
+        also inside the rooms of a VectorRoom and the environment of a wrapper like FrameStack. Unseeded
+        environments use the global random states, which are saved anyway.
+    '''
+    generators = []
+    envs = [env]
+    while envs:
+        env = envs.pop(0)
+        for name in ('np_random', 'random'):
+            generator = getattr(env, name, None)
+            if isinstance(generator, (np.random.RandomState, random.Random)):
+                generators.append(generator)
+        envs.extend(getattr(env, 'rooms', []))
+        if hasattr(env, 'env'):
+            envs.append(env.env)
+    return generators
+
+
+class Checkpointer:
+    '''
+    Saves and restores the whole training state: both networks and the optimizer, the replay buffer,
+    the NumPy and Python random states and the counters of the training loop.
+
+    The arrays of a replay buffer are split into chunks of chunk_size slots and a checkpoint only writes
+    the chunks with slots written since the previous one, so checkpoints of a big buffer cost about as
+    much as the data added in between. Every checkpoint writes new files and then replaces manifest.json,
+    which names the files that make up the checkpoint, so a crash while saving leaves the previous
+    checkpoint intact. Files no longer named by the manifest are removed afterwards.
+
+    Given the environment, the random generators of seeded environments are saved as well, so a seeded run
+    resumes with the layouts it would have played. The generators of EnvPool workers live in other
+    processes and are not saved.
+    '''
+
+    def __init__(self, directory, every=10, chunk_size=10000, compress=True):
+        '''
+        :param directory: directory of the checkpoint, created if needed
+        :param every: number of episodes between checkpoints in the training loop
+        :param chunk_size: number of replay slots per chunk file
+        :param compress: compress the chunk files with zlib
+        '''
+        self.directory = directory
+        self.every = every
+        self.chunk_size = int(chunk_size)
+        self.compress = compress
+        self._written = 0
+        self._chunks = {}
+        os.makedirs(directory, exist_ok=True)
+        # continue the numbering of an existing checkpoint so its files are never overwritten
+        manifest = self._read_manifest()
+        self._generation = 0 if manifest is None else manifest['generation']
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path('manifest.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def exists(self):
+        return self._read_manifest() is not None
+
+    def _dirty_chunks(self, replay_state, capacity):
+        '''
+        :return: chunks with slots written since the last checkpoint. The slots next to the written ones
+            count as well, since buffers can update flags of their neighbours.
+        '''
+        new = replay_state['written'] - self._written
+        if new <= 0:
+            return []
+        if new >= capacity - 2:
+            return list(range((capacity + self.chunk_size - 1) // self.chunk_size))
+        cursor = replay_state['cursor']
+        # no slot before the first one ever written
+        start = cursor - new - (1 if replay_state['written'] > new else 0)
+        slots = np.arange(start, cursor + 1) % capacity
+        return np.unique(slots // self.chunk_size).tolist()
+
+    def save(self, model, replay_buffer, training, env=None):
+        '''
+        Writes a checkpoint
+        :param model: DoubleQLearningModel
+        :param replay_buffer: an array, memmap, prioritized or frame replay buffer. Prefetchers are checkpointed
+            through the buffer they wrap.
+        :param training: picklable counters of the training loop, e.g. episode, epsilon and rewards
+        :param env: optional environment whose own random generators are saved
+        '''
+        replay_buffer = getattr(replay_buffer, 'replay_buffer', replay_buffer)
+        generation = self._generation + 1
+        replay_state = replay_buffer.state_dict()
+        chunks = dict(self._chunks)
+        if hasattr(replay_buffer, 'arrays'):
+            arrays = replay_buffer.arrays()
+            capacity = len(next(iter(arrays.values())))
+            save = np.savez_compressed if self.compress else np.savez
+            for chunk in self._dirty_chunks(replay_state, capacity):
+                rows = slice(chunk * self.chunk_size, (chunk + 1) * self.chunk_size)
+                name = 'replay-%d-%d.npz' % (chunk, generation)
+                with open(self._path(name), 'wb') as f:
+                    save(f, **{key: array[rows] for key, array in arrays.items()})
+                    _sync(f)
+                chunks[str(chunk)] = name
+
+        state = {'model': model.get_state(), 'replay': replay_state, 'training': training,
+                 'numpy_random': np.random.get_state(), 'python_random': random.getstate(),
+                 'env_random': [generator.get_state() if isinstance(generator, np.random.RandomState)
+                                else generator.getstate() for generator in _generators(env)]}
+        state_name = 'state-%d.pkl' % generation
+        with open(self._path(state_name), 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            _sync(f)
+
+        manifest = {'generation': generation, 'state': state_name, 'chunk_size': self.chunk_size, 'chunks': chunks}
+        with open(self._path('manifest.json.tmp'), 'w') as f:
+            json.dump(manifest, f)
+            _sync(f)
+        os.replace(self._path('manifest.json.tmp'), self._path('manifest.json'))
+
+        self._generation = generation
+        self._written = replay_state.get('written', 0)
+        self._chunks = chunks
+        self._remove_unused(manifest)
+
+    def _remove_unused(self, manifest):
+        used = set(manifest['chunks'].values()) | {manifest['state'], 'manifest.json'}
+        for name in os.listdir(self.directory):
+            if name not in used and (name.startswith('replay-') or name.startswith('state-')):
+                os.remove(self._path(name))
+
+    def load(self, model, replay_buffer, env=None):
+        '''
+        Restores the latest checkpoint into the model and the replay buffer and restores the random states
+        :param env: optional environment, its random generators are restored if they were saved
+        :return: the training counters passed to save, None if there is no checkpoint
+        '''
+        manifest = self._read_manifest()
+        if manifest is None:
+            return None
+        if manifest['chunk_size'] != self.chunk_size:
+            raise ValueError('Checkpoint in %s has chunk_size %d, not %d' % (
+                self.directory, manifest['chunk_size'], self.chunk_size))
+        replay_buffer = getattr(replay_buffer, 'replay_buffer', replay_buffer)
+        with open(self._path(manifest['state']), 'rb') as f:
+            state = pickle.load(f)
+        model.set_state(state['model'])
+        if manifest['chunks']:
+            arrays = replay_buffer.arrays()
+            for chunk, name in manifest['chunks'].items():
+                rows = slice(int(chunk) * self.chunk_size, (int(chunk) + 1) * self.chunk_size)
+                with np.load(self._path(name)) as data:
+                    for key, array in arrays.items():
+                        array[rows] = data[key]
+        replay_buffer.load_state_dict(state['replay'])
+        np.random.set_state(state['numpy_random'])
+        random.setstate(state['python_random'])
+        generators = _generators(env)
+        if env is not None and len(generators) != len(state.get('env_random', [])):
+            raise ValueError('Checkpoint in %s has %d environment random states, the environment has %d' % (
+                self.directory, len(state.get('env_random', [])), len(generators)))
+        for generator, generator_state in zip(generators, state.get('env_random', [])):
+            if isinstance(generator, np.random.RandomState):
+                generator.set_state(generator_state)
+            else:
+                generator.setstate(generator_state)
+
+        self._generation = manifest['generation']
+        self._written = state['replay'].get('written', 0)
+        self._chunks = manifest['chunks']
+        return state['training']
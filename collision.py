@@ -0,0 +1,119 @@
+import math
+import numpy as np
+
+
+def rects_to_boxes(rects):
+    '''
+    Converts pygame rects to boxes
+    :param rects: iterable of pygame.Rect
+    :return: array of shape (M, 4) with center x, center y, half width and half height of every rect
+    '''
+    boxes = np.array([[r.left, r.top, r.width, r.height] for r in rects], dtype=np.float64).reshape(-1, 4)
+    boxes[:, 2:] /= 2
+    boxes[:, :2] += boxes[:, 2:]
+    return boxes
+
+
+def obb_overlaps(x, y, yaw, half_length, half_width, boxes):
+    '''
+    Separating-axis test of oriented rectangles against axis-aligned boxes. The candidate axes are the
+    two box axes and the two rectangle axes, rectangles that only touch do not overlap.
+    :param x: center x of the rectangles, shape (...)
+    :param y: center y of the rectangles, shape (...)
+    :param yaw: angle of the rectangles' length axis, shape (...)
+    :param half_length: half extent along the length axis
+    :param half_width: half extent across the length axis
+    :param boxes: boxes as returned by rects_to_boxes, shape (..., M, 4)
+    :return: boolean array of shape (..., M)
+    '''
+    x = np.asarray(x)[..., np.newaxis]
+    y = np.asarray(y)[..., np.newaxis]
+    yaw = np.asarray(yaw)[..., np.newaxis]
+    cos_yaw, sin_yaw = np.cos(yaw), np.sin(yaw)
+    abs_cos, abs_sin = np.abs(cos_yaw), np.abs(sin_yaw)
+    dx = boxes[..., 0] - x
+    dy = boxes[..., 1] - y
+    half_x = boxes[..., 2]
+    half_y = boxes[..., 3]
+    separated = (np.abs(dx) >= half_x + half_length * abs_cos + half_width * abs_sin) | \
+                (np.abs(dy) >= half_y + half_length * abs_sin + half_width * abs_cos) | \
+                (np.abs(dx * cos_yaw + dy * sin_yaw) >= half_length + half_x * abs_cos + half_y * abs_sin) | \
+                (np.abs(dy * cos_yaw - dx * sin_yaw) >= half_width + half_x * abs_sin + half_y * abs_cos)
+    return ~separated
+
+
+def ray_distances(x, y, angles, boxes, max_distance):
+    '''
+    Casts rays from a point against axis-aligned boxes with the slab method
+    :param x: x of the rays' origin
+    :param y: y of the rays' origin
+    :param angles: directions of the rays, shape (R,)
+    :param boxes: boxes as returned by rects_to_boxes, shape (M, 4)
+    :param max_distance: distance returned for rays that hit nothing closer
+    :return: distance along every ray to the first box it hits, 0 if the origin is inside a box, shape (R,)
+    '''
+    angles = np.asarray(angles)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse_x = 1. / np.cos(angles)
+        inverse_y = 1. / np.sin(angles)
+        tx1 = (boxes[:, 0] - boxes[:, 2] - x) * inverse_x
+        tx2 = (boxes[:, 0] + boxes[:, 2] - x) * inverse_x
+        ty1 = (boxes[:, 1] - boxes[:, 3] - y) * inverse_y
+        ty2 = (boxes[:, 1] + boxes[:, 3] - y) * inverse_y
+        # fmin and fmax skip the nan of a ray that runs exactly along a box edge
+        near = np.fmax(np.fmin(tx1, tx2), np.fmin(ty1, ty2))
+        far = np.fmin(np.fmax(tx1, tx2), np.fmax(ty1, ty2))
+    distances = np.where((near <= far) & (far >= 0), np.maximum(near, 0), np.inf)
+    return np.minimum(distances.min(axis=1, initial=np.inf), max_distance)
+
+
+class BoxSet:
+    '''
+    Axis-aligned boxes, e.g. the obstacles or the goal of a room, that a single oriented rectangle is tested
+    against. The boxes are bucketed in a uniform grid so a test only visits the boxes near the rectangle, and
+    those are tested in plain Python, which is cheaper than NumPy for a handful of boxes.
+    '''
+
+    def __init__(self, boxes, cell_size=50):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self._cell_size = float(cell_size)
+        self._cells = {}
+        for box in self.boxes.tolist():
+            x0, y0, x1, y1 = self._cell_range(box[0], box[1], box[2], box[3])
+            for i in range(x0, x1 + 1):
+                for j in range(y0, y1 + 1):
+                    self._cells.setdefault((i, j), []).append(tuple(box))
+
+    @classmethod
+    def from_rects(cls, rects, cell_size=50):
+        return cls(rects_to_boxes(rects), cell_size)
+
+    def _cell_range(self, x, y, half_x, half_y):
+        size = self._cell_size
+        return int(math.floor((x - half_x) / size)), int(math.floor((y - half_y) / size)), \
+            int(math.floor((x + half_x) / size)), int(math.floor((y + half_y) / size))
+
+    def overlaps(self, x, y, yaw, half_length, half_width):
+        '''
+        Tests one oriented rectangle against the boxes
+        :return: True if the rectangle overlaps any box
+        '''
+        cos_yaw, sin_yaw = math.cos(yaw), math.sin(yaw)
+        abs_cos, abs_sin = abs(cos_yaw), abs(sin_yaw)
+        # half extents of the rectangle's axis-aligned bounding box
+        extent_x = half_length * abs_cos + half_width * abs_sin
+        extent_y = half_length * abs_sin + half_width * abs_cos
+        x0, y0, x1, y1 = self._cell_range(x, y, extent_x, extent_y)
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                for box_x, box_y, half_x, half_y in self._cells.get((i, j), ()):
+                    dx = box_x - x
+                    dy = box_y - y
+                    if abs(dx) >= half_x + extent_x or abs(dy) >= half_y + extent_y:
+                        continue
+                    if abs(dx * cos_yaw + dy * sin_yaw) >= half_length + half_x * abs_cos + half_y * abs_sin:
+                        continue
+                    if abs(dy * cos_yaw - dx * sin_yaw) >= half_width + half_x * abs_sin + half_y * abs_cos:
+                        continue
+                    return True
+        return False
@@ -1,16 +1,15 @@
-from keras.layers import Dense, Input
-from keras.optimizers import RMSprop
-from keras import backend as K
-from keras.initializers import RandomUniform
-from keras.models import Model
 import numpy as np
-from collections import deque
-from keras.utils.np_utils import to_categorical
-from keras.models import load_model
-from keras.models import Sequential, load_model
-from keras.layers import Dense, Flatten
-from keras.layers.convolutional import Conv2D, MaxPooling2D
-from keras.models import Model
+import json
+import multiprocessing as mp
+import os
+import queue
+import threading
+from collections import deque, namedtuple
+from multiprocessing import shared_memory
+from networks import build_network, default_network
+
+
+Transition = namedtuple("Transition", ["s", "a", "r", "next_s", "t"])
 
 
 class ExperienceReplay:
@@ -18,6 +17,8 @@ class ExperienceReplay:
     def __init__(self, buffer_size=1e+6, state_size=4):
         self.__buffer = deque(maxlen=int(buffer_size))
         self._state_size = state_size
+        self._last_state = None
+        self._last_copy = None
 
     @property
     def buffer_length(self):
@@ -29,7 +30,23 @@ class ExperienceReplay:
         :param transition:
         :return:
         '''
-        self.__buffer.append(transition)
+        # States that are views of another array, like FrameStack observations, change after they are
+        # added, so they are copied. The s of a transition is usually the next_s of the previous one
+        # and shares its copy.
+        state = self._last_copy if transition.s is self._last_state else self._own(transition.s)
+        next_state = self._own(transition.next_s)
+        self._last_state, self._last_copy = transition.next_s, next_state
+        self.__buffer.append(Transition(state, transition.a, transition.r, next_state, transition.t))
+
+    @staticmethod
+    def _own(state):
+        if isinstance(state, np.ndarray) and state.base is not None:
+            return state.copy()
+        return state
+
+    def state_dict(self):
+        # a checkpoint would pickle the whole deque every time, the array buffers only save what changed
+        raise TypeError('ExperienceReplay cannot be checkpointed, use ArrayExperienceReplay or FrameExperienceReplay')
 
     def sample_minibatch(self, batch_size=128):
         '''
@@ -52,91 +69,896 @@ class ExperienceReplay:
         return state_batch, action_batch, reward_batch, next_state_batch, t_batch
 
 
+class ArrayExperienceReplay:
+    '''
+    Replay buffer backed by preallocated NumPy arrays. Transitions are written at a cursor that
+    wraps around when the buffer is full, so adding and sampling cost the same at any fill level.
+    '''
+
+    def __init__(self, buffer_size=1e+6, state_size=4, dtype=np.float32):
+        self._capacity = int(buffer_size)
+        self._state_size = tuple(state_size) if np.iterable(state_size) else (int(state_size),)
+        self._cursor = 0
+        self._length = 0
+        self._written = 0
+        self._states = self._allocate('states', (self._capacity,) + self._state_size, dtype)
+        self._actions = self._allocate('actions', (self._capacity, 1), np.int64)
+        self._rewards = self._allocate('rewards', (self._capacity, 1), np.float64)
+        self._terminals = self._allocate('terminals', (self._capacity, 1), bool)
+        self._next_states = self._allocate('next_states', (self._capacity,) + self._state_size, dtype)
+
+    def _allocate(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    @property
+    def buffer_length(self):
+        return self._length
+
+    def add(self, transition):
+        '''
+        Writes a transition <s, a, r, s', t > at the cursor, overwriting the oldest one when full
+        :param transition:
+        :return:
+        '''
+        i = self._cursor
+        self._write(i, transition)
+        self._cursor = (i + 1) % self._capacity
+        self._length = min(self._length + 1, self._capacity)
+        self._written += 1
+
+    def arrays(self):
+        '''
+        :return: the arrays of the buffer by name, indexed by slot like the cursor, for checkpointing
+        '''
+        return {'states': self._states, 'actions': self._actions, 'rewards': self._rewards,
+                'terminals': self._terminals, 'next_states': self._next_states}
+
+    def state_dict(self):
+        '''
+        :return: position of the buffer, `written` counts the slots written since it was created
+        '''
+        return {'cursor': self._cursor, 'length': self._length, 'written': self._written}
+
+    def load_state_dict(self, state):
+        self._cursor = state['cursor']
+        self._length = state['length']
+        self._written = state['written']
+
+    def _write(self, i, transition):
+        self._states[i] = transition.s
+        self._actions[i] = transition.a
+        self._rewards[i] = transition.r
+        self._terminals[i] = transition.t
+        self._next_states[i] = transition.next_s
+
+    def sample_minibatch(self, batch_size=128, out=None):
+        '''
+        Samples uniformly with one gather per field
+        :param batch_size:
+        :param out: optional arrays of an earlier batch of the same size to write the batch into
+        :return:
+        '''
+        return self._gather(np.random.randint(self._length, size=batch_size), out)
+
+    def _gather(self, ids, out=None):
+        fields = self._states, self._actions, self._rewards, self._next_states, self._terminals
+        if out is None:
+            return tuple(field[ids] for field in fields)
+        for field, array in zip(fields, out):
+            np.take(field, ids, axis=0, out=array)
+        return out
+
+
+class MemmapExperienceReplay(ArrayExperienceReplay):
+    '''
+    ArrayExperienceReplay whose arrays are memory-mapped files in a directory, so the buffer can be
+    larger than RAM and is picked up again by the next run that opens the same directory.
+    The cursor and fill level are written to meta.json every flush_every transitions and on flush().
+    '''
+
+    def __init__(self, directory, buffer_size=1e+6, state_size=4, dtype=np.float32, flush_every=1000):
+        self._directory = directory
+        self._flush_every = flush_every
+        self._unflushed = 0
+        os.makedirs(directory, exist_ok=True)
+        meta = self.__read_meta()
+        state_size = tuple(state_size) if np.iterable(state_size) else (int(state_size),)
+        layout = {'capacity': int(buffer_size), 'state_size': list(state_size), 'dtype': np.dtype(dtype).str}
+        if meta is not None and any(meta[key] != value for key, value in layout.items()):
+            raise ValueError('Replay buffer in %s was created with %s, not %s' % (
+                directory, {key: meta[key] for key in layout}, layout))
+        self._mode = 'w+' if meta is None else 'r+'
+        super(MemmapExperienceReplay, self).__init__(buffer_size, state_size, dtype)
+        if meta is not None:
+            self._cursor = meta['cursor']
+            self._length = meta['length']
+        self.__layout = layout
+        self.flush()
+
+    def _allocate(self, name, shape, dtype):
+        return np.memmap(os.path.join(self._directory, name + '.dat'), dtype=dtype, mode=self._mode, shape=shape)
+
+    def __read_meta(self):
+        try:
+            with open(os.path.join(self._directory, 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def add(self, transition):
+        super(MemmapExperienceReplay, self).add(transition)
+        self._unflushed += 1
+        if self._unflushed >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the arrays and the buffer position to disk
+        '''
+        for array in (self._states, self._actions, self._rewards, self._terminals, self._next_states):
+            array.flush()
+        meta = dict(self.__layout, cursor=self._cursor, length=self._length)
+        path = os.path.join(self._directory, 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+        self._unflushed = 0
+
+    def sample_minibatch(self, batch_size=128, out=None):
+        '''
+        Samples uniformly, reading the rows in file order
+        :param batch_size:
+        :return:
+        '''
+        return self._gather(np.sort(np.random.randint(self._length, size=batch_size)), out)
+
+
+class SharedExperienceReplay(ArrayExperienceReplay):
+    '''
+    ArrayExperienceReplay in shared memory, so actor processes can add transitions while a learner
+    samples from it. Pass the buffer to the actors as a Process argument and they attach to the same
+    memory. Adds are serialized with a lock, sampling takes no lock and can read a transition that is
+    being overwritten at the same time.
+    '''
+
+    def __init__(self, buffer_size=1e+6, state_size=4, dtype=np.float32, context='spawn'):
+        self._blocks = {}
+        self._owner = True
+        self._lock = mp.get_context(context).Lock()
+        super(SharedExperienceReplay, self).__init__(buffer_size, state_size, dtype)
+        # cursor and length, shared with the other processes
+        self._position = self._allocate('position', (2,), np.int64)
+
+    def _allocate(self, name, shape, dtype):
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+        self._blocks[name] = (block, shape, np.dtype(dtype).str)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array[...] = 0
+        return array
+
+    def __getstate__(self):
+        return {'capacity': self._capacity, 'state_size': self._state_size, 'lock': self._lock,
+                'blocks': {name: (block.name, shape, dtype) for name, (block, shape, dtype) in self._blocks.items()}}
+
+    def __setstate__(self, state):
+        self._capacity = state['capacity']
+        self._state_size = state['state_size']
+        self._lock = state['lock']
+        self._owner = False
+        self._blocks = {}
+        for name, (block_name, shape, dtype) in state['blocks'].items():
+            block = shared_memory.SharedMemory(name=block_name)
+            self._blocks[name] = (block, shape, dtype)
+            setattr(self, '_' + name, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+    @property
+    def buffer_length(self):
+        return int(self._position[1])
+
+    def add(self, transition):
+        '''
+        Writes a transition <s, a, r, s', t > at the shared cursor
+        :param transition:
+        :return:
+        '''
+        with self._lock:
+            i = int(self._position[0])
+            self._write(i, transition)
+            self._position[0] = (i + 1) % self._capacity
+            self._position[1] = min(self._position[1] + 1, self._capacity)
+
+    def sample_minibatch(self, batch_size=128, out=None):
+        return self._gather(np.random.randint(self.buffer_length, size=batch_size), out)
+
+    def state_dict(self):
+        raise TypeError('A shared replay buffer is written by other processes and cannot be checkpointed')
+
+    def close(self):
+        '''
+        Detaches from the shared memory, the process that created the buffer also frees it
+        '''
+        for name, (block, _, _) in self._blocks.items():
+            delattr(self, '_' + name)
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = {}
+
+
+class SumTree:
+    '''
+    Binary tree over a power of two number of leaves where every node holds the sum of its children.
+    Leaf i holds the priority of slot i, so proportional sampling and updates are O(log n).
+    '''
+
+    def __init__(self, capacity):
+        self._num_leaves = 1 << max(int(capacity) - 1, 0).bit_length()
+        self._tree = np.zeros(2 * self._num_leaves)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def get(self, ids):
+        return self._tree[np.asarray(ids) + self._num_leaves]
+
+    def update(self, ids, priorities):
+        '''
+        Sets the priorities of a batch of slots and recomputes the sums above them one level at a time
+        :param ids: slot indices
+        :param priorities: new priorities
+        '''
+        nodes = np.asarray(ids) + self._num_leaves
+        self._tree[nodes] = priorities
+        while self._num_leaves > 1:
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+
+    def find(self, values):
+        '''
+        Finds the slots whose cumulative priority ranges contain the given values
+        :param values: values in [0, total)
+        :return: slot indices
+        '''
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self._num_leaves:
+            left = 2 * nodes
+            left_sum = self._tree[left]
+            go_right = values >= left_sum
+            values -= left_sum * go_right
+            nodes = left + go_right
+        return nodes - self._num_leaves
+
+
+class PrioritizedExperienceReplay(ArrayExperienceReplay):
+    '''
+    Replay buffer that samples transitions proportionally to priority^alpha and corrects the bias
+    with importance-sampling weights. New transitions get the highest priority seen so far.
+    '''
+
+    def __init__(self, buffer_size=1e+6, state_size=4, dtype=np.float32, alpha=.6, beta=.4,
+                 beta_increment=1e-5, eps=1e-6):
+        '''
+        :param alpha: how much prioritization is used, 0 is uniform sampling
+        :param beta: initial importance-sampling exponent, annealed towards 1 on every sample
+        :param beta_increment: amount added to beta on every sample
+        :param eps: added to the absolute TD errors so no transition gets zero priority
+        '''
+        super(PrioritizedExperienceReplay, self).__init__(buffer_size, state_size, dtype)
+        self._alpha = alpha
+        self._beta = beta
+        self._beta_increment = beta_increment
+        self._eps = eps
+        self._max_priority = 1.
+        self._tree = SumTree(self._capacity)
+
+    def add(self, transition):
+        i = self._cursor
+        super(PrioritizedExperienceReplay, self).add(transition)
+        self._tree.update([i], self._max_priority)
+
+    def sample_minibatch(self, batch_size=128, out=None):
+        '''
+        Draws one transition from each of batch_size equal segments of the total priority
+        :param batch_size:
+        :return: states, actions, rewards, next states, terminals, ids, importance-sampling weights
+        '''
+        segment = self._tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+        ids = np.minimum(self._tree.find(values), self._length - 1)
+        probabilities = self._tree.get(ids) / self._tree.total
+        weights = (self._length * probabilities) ** -self._beta
+        weights /= weights.max()
+        self._beta = min(1., self._beta + self._beta_increment)
+        return self._gather(ids, out) + (ids, weights.reshape(batch_size, 1))
+
+    def update_priorities(self, ids, td_errors):
+        '''
+        Sets the priorities of sampled transitions from their TD errors
+        :param ids: ids returned by sample_minibatch
+        :param td_errors: TD errors of the transitions
+        '''
+        priorities = (np.abs(np.ravel(td_errors)) + self._eps) ** self._alpha
+        self._tree.update(ids, priorities)
+        self._max_priority = max(self._max_priority, priorities.max())
+
+    def state_dict(self):
+        state = super(PrioritizedExperienceReplay, self).state_dict()
+        # priorities change anywhere in the buffer, so they are saved whole
+        state.update(priorities=self._tree.get(np.arange(self._capacity)), max_priority=self._max_priority,
+                     beta=self._beta)
+        return state
+
+    def load_state_dict(self, state):
+        super(PrioritizedExperienceReplay, self).load_state_dict(state)
+        self._tree.update(np.arange(self._capacity), state['priorities'])
+        self._max_priority = state['max_priority']
+        self._beta = state['beta']
+
+
+class FramePalette:
+    '''
+    Maps the few distinct pixel values seen in the frames to uint8 codes, so a frame can be stored
+    with one byte per pixel and decoded back to its original values.
+    '''
+
+    def __init__(self, dtype=np.float32):
+        self._values = np.zeros(256, dtype=dtype)
+        self._codes = {}
+
+    def encode(self, frame, out):
+        '''
+        Writes the palette codes of a frame into out
+        :param frame: array of pixel values
+        :param out: uint8 array with the same number of elements as frame
+        '''
+        values, inverse = np.unique(frame, return_inverse=True)
+        lut = np.array([self.__code(value) for value in values], dtype=np.uint8)
+        out[...] = lut[inverse].reshape(out.shape)
+
+    @property
+    def dtype(self):
+        return self._values.dtype
+
+    def decode(self, codes, out=None):
+        return np.take(self._values, codes, out=out, mode='clip')
+
+    def state_dict(self):
+        return {'values': self._values[:len(self._codes)].copy()}
+
+    def load_state_dict(self, state):
+        values = state['values']
+        self._values[:len(values)] = values
+        self._codes = {value: code for code, value in enumerate(self._values[:len(values)])}
+
+    def __code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            if len(self._codes) == 256:
+                raise ValueError('Frames contain more than 256 distinct values and cannot be palette encoded')
+            code = len(self._codes)
+            self._codes[value] = code
+            self._values[code] = value
+        return code
+
+
+class FrameExperienceReplay:
+    '''
+    Replay buffer that stores every frame once, in episode order, as uint8. A transition is kept at
+    the position of its state s and its next state s' is the frame right after it, so s' is rebuilt
+    from the frame index when sampling.
+
+    A transition continues the current episode when its s is the same object as the next_s of the
+    previous transition, which is what the training loop does with `state = new_state`. Otherwise
+    s is written as the first frame of a new episode.
+
+    With history=k, sampled states are the last k frames stacked along the last axis, like FrameStack
+    observations, with the first frame of an episode repeated before it. FrameStack observations can be
+    added directly, only their newest frame is stored.
+    '''
+
+    def __init__(self, buffer_size=1e+6, state_size=4, palette=True, dtype=np.float32, history=1):
+        '''
+        :param buffer_size: number of frames to keep
+        :param state_size: shape of a single frame
+        :param palette: encode frames with a FramePalette, otherwise frames are stored with a plain uint8 cast
+        :param dtype: dtype of the decoded frames when a palette is used
+        :param history: number of frames stacked into a sampled state. Stacked batches are written into
+            arrays that are reused by the next sample_minibatch call.
+        '''
+        self._capacity = int(buffer_size)
+        if self._capacity < 2:
+            raise ValueError('buffer_size must hold at least two frames')
+        self._state_size = tuple(state_size) if np.iterable(state_size) else (int(state_size),)
+        self._palette = FramePalette(dtype) if palette else None
+        self._history = history
+        self._batch_buffers = {}
+        self._cursor = 0
+        self._num_frames = 0
+        self._length = 0
+        self._written = 0
+        self._last_frame = None
+        self._frames = np.zeros((self._capacity,) + self._state_size, dtype=np.uint8)
+        self._actions = np.zeros((self._capacity, 1), dtype=np.int64)
+        self._rewards = np.zeros((self._capacity, 1))
+        self._terminals = np.zeros((self._capacity, 1), dtype=bool)
+        # True where the frame is the state of a stored transition, i.e. the next frame is its s'
+        self._valid = np.zeros(self._capacity, dtype=bool)
+        # True where the frame has no predecessor in its episode, stacking never reaches past it
+        self._first = np.zeros(self._capacity, dtype=bool)
+
+    @property
+    def buffer_length(self):
+        return self._length
+
+    def add(self, transition):
+        '''
+        Adds a transition <s, a, r, s', t > to the replay buffer
+        :param transition:
+        :return:
+        '''
+        if transition.s is not self._last_frame:
+            self._write_frame(self._newest_frame(transition.s), first=True)
+        i = (self._cursor - 1) % self._capacity
+        self._actions[i] = transition.a
+        self._rewards[i] = transition.r
+        self._terminals[i] = transition.t
+        self._write_frame(self._newest_frame(transition.next_s), first=False)
+        self._valid[i] = True
+        self._length += 1
+        self._last_frame = transition.next_s
+
+    def _newest_frame(self, state):
+        # the newest frame of a stacked state is in its last channels
+        channels = self._state_size[-1]
+        if np.shape(state)[-1] != channels:
+            return state[..., -channels:]
+        return state
+
+    def _write_frame(self, frame, first):
+        i = self._cursor
+        if self._valid[i]:
+            self._valid[i] = False
+            self._length -= 1
+        if self._palette is None:
+            self._frames[i] = np.reshape(frame, self._state_size)
+        else:
+            self._palette.encode(frame, self._frames[i])
+        self._first[i] = first
+        # the oldest frame loses its predecessor to the next write
+        self._first[(i + 1) % self._capacity] = True
+        self._cursor = (i + 1) % self._capacity
+        self._num_frames = min(self._num_frames + 1, self._capacity)
+        self._written += 1
+
+    def arrays(self):
+        '''
+        :return: the arrays of the buffer by name, indexed by frame like the cursor, for checkpointing
+        '''
+        return {'frames': self._frames, 'actions': self._actions, 'rewards': self._rewards,
+                'terminals': self._terminals, 'valid': self._valid, 'first': self._first}
+
+    def state_dict(self):
+        '''
+        :return: position of the buffer and the palette, `written` counts the frames written since it was created
+        '''
+        return {'cursor': self._cursor, 'num_frames': self._num_frames, 'length': self._length,
+                'written': self._written, 'palette': None if self._palette is None else self._palette.state_dict()}
+
+    def load_state_dict(self, state):
+        self._cursor = state['cursor']
+        self._num_frames = state['num_frames']
+        self._length = state['length']
+        self._written = state['written']
+        if self._palette is not None:
+            self._palette.load_state_dict(state['palette'])
+        # the next transition starts a new episode
+        self._last_frame = None
+
+    def _decode(self, frames):
+        return frames if self._palette is None else self._palette.decode(frames)
+
+    def _stack(self, ids, out):
+        '''
+        Writes the last `history` frames up to every id into out, oldest first, repeating the first
+        frame of an episode in place of frames from before it
+        :param ids: frame indices
+        :param out: array of shape (len(ids),) + state_size[:-1] + (history, channels)
+        '''
+        for j in range(self._history - 1, -1, -1):
+            if self._palette is None:
+                np.take(self._frames, ids, axis=0, out=out[..., j, :], mode='clip')
+            else:
+                self._palette.decode(self._frames[ids], out=out[..., j, :])
+            ids = np.where(self._first[ids], ids, (ids - 1) % self._capacity)
+
+    def _batch_buffer(self, batch_size):
+        if batch_size not in self._batch_buffers:
+            dtype = np.uint8 if self._palette is None else self._palette.dtype
+            shape = (batch_size,) + self._state_size[:-1] + (self._history, self._state_size[-1])
+            self._batch_buffers[batch_size] = np.zeros(shape, dtype=dtype), np.zeros(shape, dtype=dtype)
+        return self._batch_buffers[batch_size]
+
+    def sample_minibatch(self, batch_size=128):
+        '''
+        Samples uniformly among the stored transitions, redrawing ids that hit an episode's last frame
+        :param batch_size:
+        :return:
+        '''
+        if self._length == 0:
+            raise ValueError('Cannot sample from an empty replay buffer')
+        ids = np.random.randint(self._num_frames, size=batch_size)
+        invalid = ~self._valid[ids]
+        while invalid.any():
+            ids[invalid] = np.random.randint(self._num_frames, size=np.count_nonzero(invalid))
+            invalid = ~self._valid[ids]
+        next_ids = (ids + 1) % self._capacity
+        if self._history > 1:
+            states, next_states = self._batch_buffer(batch_size)
+            self._stack(ids, states)
+            self._stack(next_ids, next_states)
+            stacked_shape = (batch_size,) + self._state_size[:-1] + (self._history * self._state_size[-1],)
+            return states.reshape(stacked_shape), self._actions[ids], self._rewards[ids], \
+                next_states.reshape(stacked_shape), self._terminals[ids]
+        return self._decode(self._frames[ids]), self._actions[ids], self._rewards[ids], \
+            self._decode(self._frames[next_ids]), self._terminals[ids]
+
+
+class MinibatchPrefetcher:
+    '''
+    Wraps a replay buffer and samples the next minibatches in a background thread, so assembling a batch
+    overlaps with the update step and with stepping the environment. It has the interface of a replay
+    buffer and can replace one in the training loops.
+
+    Batches are written into num_batches + 1 sets of arrays that are reused, a batch returned by
+    sample_minibatch stays valid until the next call. The buffer is locked while it is sampled or added to.
+    Batches of a prioritized buffer are drawn before the priorities of the previous batches are updated.
+    '''
+
+    def __init__(self, replay_buffer, batch_size=128, num_batches=2):
+        '''
+        :param replay_buffer: buffer to sample from
+        :param batch_size: size of every minibatch
+        :param num_batches: number of batches that are prepared ahead
+        '''
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._free = queue.Queue()
+        self._ready = queue.Queue(maxsize=num_batches)
+        for slot in range(num_batches + 1):
+            self._free.put(slot)
+        self._arrays = [None] * (num_batches + 1)
+        self._current = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def buffer_length(self):
+        return self.replay_buffer.buffer_length
+
+    def add(self, transition):
+        with self._lock:
+            self.replay_buffer.add(transition)
+
+    def update_priorities(self, ids, td_errors):
+        with self._lock:
+            self.replay_buffer.update_priorities(ids, td_errors)
+
+    def __sample(self, slot):
+        with self._lock:
+            if isinstance(self.replay_buffer, ArrayExperienceReplay) and self._arrays[slot] is not None:
+                return self.replay_buffer.sample_minibatch(self.batch_size, out=self._arrays[slot])
+            batch = self.replay_buffer.sample_minibatch(self.batch_size)
+            if self._arrays[slot] is None:
+                self._arrays[slot] = tuple(np.empty_like(array) for array in batch[:5])
+            # copy under the lock, some buffers return arrays they reuse themselves
+            for array, sampled in zip(self._arrays[slot], batch[:5]):
+                np.copyto(array, sampled)
+            return self._arrays[slot] + tuple(batch[5:])
+
+    def __run(self):
+        while not self._stop.is_set():
+            try:
+                slot = self._free.get(timeout=.1)
+            except queue.Empty:
+                continue
+            try:
+                batch = self.__sample(slot)
+            except Exception as e:
+                self._ready.put((slot, e))
+                return
+            self._ready.put((slot, batch))
+
+    def sample_minibatch(self, batch_size=None):
+        '''
+        Returns the next prepared minibatch and hands the arrays of the previous one back to the sampler
+        :param batch_size: must be None or the batch_size of the prefetcher
+        :return: a batch as returned by the wrapped buffer
+        '''
+        if batch_size is not None and batch_size != self.batch_size:
+            raise ValueError('Prefetcher samples batches of %d, not %d' % (self.batch_size, batch_size))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.__run, daemon=True)
+            self._thread.start()
+        if self._current is not None:
+            self._free.put(self._current)
+        self._current, batch = self._ready.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        '''
+        Stops the sampling thread
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            # let the thread exit when it is blocked on a full queue
+            while self._thread.is_alive():
+                try:
+                    self._ready.get(timeout=.1)
+                except queue.Empty:
+                    pass
+            self._thread = None
+
+
 class DoubleQLearningModel(object):
-    def __init__(self, state_dim, learning_rate, action_dim):
+    # built by _build on first use, so creating a model does not load TensorFlow
+    _LAZY_ATTRIBUTES = ('_online_model', '_offline_model', '_optimizer', '_q_values', '_both_q_values', '_train_step',
+                        '_swap_weights', '_copy_weights', '_soft_update_weights')
+
+    def __init__(self, state_dim, learning_rate, action_dim, input_scale=1., jit_compile=False,
+                 target_update='swap', target_update_period=1, tau=.005, network=None, network_options=None):
+        '''
+        :param network: name of a network in networks.NETWORKS, by default 'mlp' for flat states and 'small_cnn' for frames
+        :param network_options: options of the network's builder, e.g. {'hidden_units': (128, 128)} for 'mlp'
+        :param input_scale: factor the network applies to its inputs, e.g. FramePreprocessor.scale for uint8 frames
+        :param jit_compile: compile the graph functions with XLA instead of running them as plain TF graphs
+        :param target_update: how the offline network follows the online one after update steps:
+            'swap' switches the two networks with probability .5 after every update,
+            'hard' copies the online weights into the offline network every target_update_period updates,
+            'polyak' moves the offline weights a fraction tau towards the online ones every target_update_period updates
+        :param target_update_period: number of updates between 'hard' and 'polyak' target updates
+        :param tau: step size of 'polyak' target updates
+        '''
+        if target_update not in ('swap', 'hard', 'polyak'):
+            raise ValueError("target_update must be 'swap', 'hard' or 'polyak', not %r" % (target_update,))
+        self._target_update = target_update
+        self._target_update_period = target_update_period
+        self._tau = tau
+        self._num_updates = 0
         self._lr = learning_rate
-        self._state_dim = state_dim
+        self._state_dim = tuple(state_dim) if np.iterable(state_dim) else (int(state_dim),)
         self._action_dim = action_dim
-        # define the two deep Q-networks
-        self._online_model = self.__build_model()
-        self._offline_model = self.__build_model()
-        # define ops for updating the networks
-        self._update = self.__mse()
+        self._input_scale = input_scale
+        self._jit_compile = jit_compile
+        self._network = network or default_network(self._state_dim)
+        self._network_options = dict(network_options or {})
+        self._built = False
+
+    @classmethod
+    def from_env(cls, env, learning_rate=1e-4, preprocess=None, **kwargs):
+        '''
+        Creates a model for an environment, with one output per action of env.action_space
+        :param preprocess: FramePreprocessor the states go through, its output shape and scale are used
+            instead of env.observation_space
+        :param kwargs: further arguments of the model, e.g. network
+        '''
+        if preprocess is not None and hasattr(preprocess, 'output_shape'):
+            kwargs.setdefault('input_scale', preprocess.scale)
+            state_dim = preprocess.output_shape
+        else:
+            state_dim = env.observation_space.shape[0]
+        return cls(state_dim, learning_rate, env.action_space.n, **kwargs)
+
+    def __getattr__(self, name):
+        # only called for missing attributes, so the networks cost nothing once they are built
+        if name in self._LAZY_ATTRIBUTES and not self.__dict__.get('_built', True):
+            self._build()
+            return getattr(self, name)
+        raise AttributeError("%r object has no attribute %r" % (type(self).__name__, name))
+
+    def _build(self):
+        '''
+        Builds the two deep Q-networks and the graph functions for acting and updating them
+        '''
+        self._online_model = self._build_model()
+        self._offline_model = self._build_model()
+        self.__compile()
+
+    def save_model(self, directory='models'):
+        self._online_model.save(os.path.join(directory, '_online_model2.h5'))
+        self._offline_model.save(os.path.join(directory, '_offline_model2.h5'))
 
-    def save_model(self):
-        self._online_model.save('models/_online_model2.h5')
-        self._offline_model.save('models/_offline_model2.h5')
+    def load(self, directory='models'):
+        from keras.models import load_model
+        self._online_model = load_model(os.path.join(directory, '_online_model2.h5'))
+        self._offline_model = load_model(os.path.join(directory, '_offline_model2.h5'))
+        self.__compile()
+
+    def get_state(self):
+        '''
+        :return: weights of both networks, the optimizer's variables and the update counter, for checkpointing
+        '''
+        # create the optimizer's slots if no update has been made yet, so the state always has the same layout
+        self._optimizer.build(self._online_model.trainable_variables)
+        return {'online': self._online_model.get_weights(), 'offline': self._offline_model.get_weights(),
+                'optimizer': [variable.numpy() for variable in self._optimizer.variables],
+                'num_updates': self._num_updates}
 
-    def load(self):
-        self._online_model = load_model('models/_online_model2.h5')
-        self._offline_model = load_model('models/_offline_model2.h5')
+    def set_state(self, state):
+        '''
+        Restores a state from get_state in place, the graph functions keep working on the same variables
+        '''
+        self._online_model.set_weights(state['online'])
+        self._offline_model.set_weights(state['offline'])
+        self._optimizer.build(self._online_model.trainable_variables)
+        for variable, value in zip(self._optimizer.variables, state['optimizer']):
+            variable.assign(value)
+        self._num_updates = state['num_updates']
 
-    def __build_model(self):
+    def _build_model(self):
         '''
         Define all the layers in the network
         :return: Keras model
         '''
-        model = Sequential()
-        model.add(Conv2D(16, (5, 5), activation='relu', input_shape=self._state_dim))
-        model.add(MaxPooling2D(pool_size=(2, 2)))
-        model.add(Flatten())
-        model.add(Dense(16, activation='relu'))
-        model.add(Dense(6, activation='linear'))
-        return model
+        return build_network(self._network, self._state_dim, self._action_dim, self._input_scale,
+                             **self._network_options)
 
-    def __mse(self):
+    def __compile(self):
         '''
-        Mean squared error loss
-        :return: Keras function
+        Traces the graph functions that evaluate and train the current networks. The functions take
+        batches of any size, so they are traced once and called without the per-call overhead of predict.
         '''
-        q_values = self._online_model.output
-        # trace of taken actions
-        target = K.placeholder(shape=(None,), name='target_value')
-        a_1_hot = K.placeholder(shape=(None, self._action_dim), name='chosen_actions')
+        import tensorflow as tf
+        from keras.optimizers import RMSprop
+        online_model = self._online_model
+        offline_model = self._offline_model
+        action_dim = self._action_dim
+        optimizer = RMSprop(learning_rate=self._lr)
+        states_spec = tf.TensorSpec((None,) + self._state_dim, tf.float32)
+        batch_spec = tf.TensorSpec((None,), tf.float32)
+
+        @tf.function(input_signature=[states_spec], jit_compile=self._jit_compile)
+        def q_values(states):
+            return online_model(states, training=False)
+
+        @tf.function(input_signature=[states_spec], jit_compile=self._jit_compile)
+        def both_q_values(states):
+            return online_model(states, training=False), offline_model(states, training=False)
+
+        @tf.function(input_signature=[states_spec, batch_spec, tf.TensorSpec((None,), tf.int32), batch_spec],
+                     jit_compile=self._jit_compile)
+        def train_step(states, target, actions, weights):
+            # Mean squared error weighted by the importance-sampling weights, all ones for uniform replay
+            with tf.GradientTape() as tape:
+                q_value = tf.reduce_sum(online_model(states, training=True) * tf.one_hot(actions, action_dim), axis=1)
+                td_error = target - q_value
+                mse = tf.reduce_mean(weights * tf.square(td_error))
+            gradients = tape.gradient(mse, online_model.trainable_weights)
+            optimizer.apply_gradients(zip(gradients, online_model.trainable_weights))
+            return td_error
+
+        # The target updates assign the framework variables in place, nothing is copied through NumPy
+        weight_pairs = list(zip(online_model.weights, offline_model.weights))
+        tau = tf.constant(self._tau, tf.float32)
+
+        @tf.function
+        def swap_weights():
+            for online_weight, offline_weight in weight_pairs:
+                online_value = tf.identity(online_weight)
+                online_weight.assign(offline_weight)
+                offline_weight.assign(online_value)
 
-        q_value = K.sum(q_values * a_1_hot, axis=1)
-        squared_error = K.square(target - q_value)
-        mse = K.mean(squared_error)
-        optimizer = RMSprop(lr=self._lr)
-        updates = optimizer.get_updates(loss=mse, params=self._online_model.trainable_weights)
+        @tf.function
+        def copy_weights():
+            for online_weight, offline_weight in weight_pairs:
+                offline_weight.assign(online_weight)
 
-        return K.function(inputs=[self._online_model.input, target, a_1_hot], outputs=[], updates=updates)
+        @tf.function
+        def soft_update_weights():
+            for online_weight, offline_weight in weight_pairs:
+                offline_weight.assign(offline_weight + tf.cast(tau, offline_weight.dtype) * (online_weight - offline_weight))
+
+        self._optimizer = optimizer
+        self._q_values = q_values
+        self._both_q_values = both_q_values
+        self._train_step = train_step
+        self._swap_weights = swap_weights
+        self._copy_weights = copy_weights
+        self._soft_update_weights = soft_update_weights
+        self._built = True
+
+    def __as_batch(self, states):
+        return np.asarray(states, dtype=np.float32).reshape((-1,) + self._state_dim)
+
+    def get_weights(self):
+        '''
+        :return: weights of the online network
+        '''
+        return self._online_model.get_weights()
+
+    def set_weights(self, weights):
+        '''
+        Sets the weights of the online network, e.g. on actors that only act
+        :param weights: weights as returned by get_weights
+        '''
+        self._online_model.set_weights(weights)
 
     def get_q_values_for_both_models(self, states):
         '''
-        Calcuates Q-values for both models
-        :param states: set of states
+        Calcuates Q-values for both models in one forward pass
+        :param states: batch of states of any size
         :return: Q-values for online network, Q-values for offline network
         '''
-        states = states.reshape((128, 400, 400, 1)) #TODO Remove constant values
-        return self._online_model.predict(states), self._offline_model.predict(states)
+        q_online, q_offline = self._both_q_values(self.__as_batch(states))
+        return q_online.numpy(), q_offline.numpy()
 
     def get_q_values(self, state):
         '''
         Predict all Q-values for the current state
+        :param state: a state or a batch of states
+        :return: Q-values, shape (N, num actions)
+        '''
+        return self._q_values(self.__as_batch(state)).numpy()
+
+    def act(self, state, eps=0.):
+        '''
+        Epsilon-greedy action for a single state
         :param state:
-        :return:
+        :param eps: probability of taking a uniform random action
+        :return: action index
         '''
-        return self._online_model.predict(state)
+        if eps > 0 and np.random.uniform() < eps:
+            return np.random.randint(self._action_dim)
+        return int(np.argmax(self._q_values(self.__as_batch(state))[0]))
 
-    def update(self, states, td_target, actions):
+    def update(self, states, td_target, actions, weights=None, sync_target=True):
         '''
-        Performes one update step on the model and switches between online and offline network
+        Performes one update step on the model and updates the offline network as set by target_update
         :param states: batch of states
         :param td_target: batch of temporal difference targets
         :param actions: batch of actions
-        :return:
+        :param weights: batch of importance-sampling weights for the loss, None for uniform weights
+        :param sync_target: False to leave the offline network to a separate update_target call
+        :return: TD errors of the batch before the update
+        '''
+        td_target = np.asarray(td_target, dtype=np.float32).reshape(-1)
+        actions = np.asarray(actions, dtype=np.int32).reshape(-1)
+        weights = np.ones_like(td_target) if weights is None else np.asarray(weights, dtype=np.float32).reshape(-1)
+        td_error = self._train_step(self.__as_batch(states), td_target, actions, weights).numpy()
+        self._num_updates += 1
+        if sync_target:
+            self.update_target()
+        return td_error
+
+    def update_target(self):
         '''
-        actions_one_hot = to_categorical(np.squeeze(actions), self._action_dim)
-        self._update([states, np.squeeze(td_target), actions_one_hot])
-        if np.random.uniform() > .5:
-            self.__switch_weights()
+        Switches between, copies or blends the online and offline networks
+        '''
+        if self._target_update == 'swap':
+            if np.random.uniform() > .5:
+                self._swap_weights()
+        elif self._num_updates % self._target_update_period == 0:
+            if self._target_update == 'hard':
+                self._copy_weights()
+            else:
+                self._soft_update_weights()
+
+
+class MLPDoubleQLearningModel(DoubleQLearningModel):
+    '''
+    DoubleQLearningModel with the 'mlp' network, for low-dimensional states such as the feature
+    vectors of Room(observation='state')
+    '''
 
-    def __switch_weights(self):
+    def __init__(self, state_dim, learning_rate, action_dim, hidden_units=(64, 64), **kwargs):
         '''
-        Switches between online and offline networks
+        :param hidden_units: number of units of every hidden layer
         '''
-        offline_params = self._offline_model.get_weights()
-        online_params = self._online_model.get_weights()
-        self._online_model.set_weights(offline_params)
-        self._offline_model.set_weights(online_params)
+        super(MLPDoubleQLearningModel, self).__init__(state_dim, learning_rate, action_dim, network='mlp',
+                                                      network_options={'hidden_units': tuple(hidden_units)}, **kwargs)
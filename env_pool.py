@@ -0,0 +1,164 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+import numpy as np
+
+
+def _worker(env_fn, pipe, parent_pipe):
+    '''
+    Runs one environment in a subprocess. Observations are written into the worker's row of the
+    shared observation array, only rewards and terminal flags go through the pipe. The observation of
+    the reset that gives the shape is kept for the pool's first reset, so seeded rooms start with their
+    first layout.
+    '''
+    parent_pipe.close()
+    env = env_fn()
+    observation = np.asarray(env.reset())
+    pipe.send((observation.shape, observation.dtype.str, env.action_space, env.observation_space))
+    shm_name, offset = pipe.recv()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    row = np.ndarray(observation.shape, dtype=observation.dtype, buffer=shm.buf, offset=offset)
+    row[...] = observation
+    pipe.send(None)
+    fresh = True
+    try:
+        while True:
+            command, data = pipe.recv()
+            if command == 'step':
+                observation, reward, terminal, _ = env.step(data)
+                row[...] = observation
+                pipe.send((reward, terminal))
+                fresh = False
+            elif command == 'reset':
+                if not fresh:
+                    row[...] = env.reset()
+                fresh = False
+                pipe.send(None)
+            elif command == 'close':
+                break
+    finally:
+        del row
+        shm.close()
+
+
+class EnvPool:
+    '''
+    Environments running in worker processes. Every worker writes its observations into one row of a
+    shared-memory array, so frames are never pickled through the pipes.
+
+    step/reset have the same interface as VectorRoom. step_async/step_wait step a subset of the workers
+    and collect whichever of them are done first. The returned observations are views of the shared
+    array, copy them if they have to outlive the next step of their worker.
+    '''
+
+    def __init__(self, env_fns, context='spawn'):
+        '''
+        :param env_fns: one picklable callable per worker that creates its environment, e.g.
+            functools.partial(Room, headless=True, renderer='numpy')
+        :param context: multiprocessing start method. With 'fork' the workers share the parent's random state.
+        '''
+        ctx = mp.get_context(context)
+        self.num_envs = len(env_fns)
+        self._pipes = []
+        self._processes = []
+        for env_fn in env_fns:
+            parent_pipe, child_pipe = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(env_fn, child_pipe, parent_pipe), daemon=True)
+            process.start()
+            child_pipe.close()
+            self._pipes.append(parent_pipe)
+            self._processes.append(process)
+
+        specs = [pipe.recv() for pipe in self._pipes]
+        shape, dtype, self.action_space, self.observation_space = specs[0]
+        if any(spec[:2] != (shape, dtype) for spec in specs):
+            raise ValueError('All environments in a pool must have the same observation shape and dtype')
+        row_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=max(self.num_envs * row_size, 1))
+        self.observations = np.ndarray((self.num_envs,) + tuple(shape), dtype=dtype, buffer=self._shm.buf)
+        for i, pipe in enumerate(self._pipes):
+            pipe.send((self._shm.name, i * row_size))
+        for pipe in self._pipes:
+            pipe.recv()
+
+        self.rewards = np.zeros(self.num_envs)
+        self.terminals = np.zeros(self.num_envs, dtype=bool)
+        self._waiting = np.zeros(self.num_envs, dtype=bool)
+
+    def reset(self, indices=None):
+        '''
+        Resets the given environments
+        :param indices: environments to reset, all if None
+        :return: observations of the reset environments
+        '''
+        indices = np.arange(self.num_envs) if indices is None else np.asarray(indices)
+        if self._waiting[indices].any():
+            raise RuntimeError('Cannot reset environments that are still stepping')
+        for i in indices:
+            self._pipes[i].send(('reset', None))
+        for i in indices:
+            self._pipes[i].recv()
+        return self.observations[indices]
+
+    def render(self):
+        pass
+
+    def step(self, actions):
+        '''
+        Steps all environments and waits for all of them
+        :param actions: one action per environment
+        :return: observations, rewards, terminals, None
+        '''
+        self.step_async(actions)
+        self.step_wait()
+        return self.observations, self.rewards.copy(), self.terminals.copy(), None
+
+    def step_async(self, actions, indices=None):
+        '''
+        Starts stepping the given environments without waiting for them
+        :param actions: one action per environment in indices
+        :param indices: environments to step, all if None
+        '''
+        indices = np.arange(self.num_envs) if indices is None else np.asarray(indices)
+        if self._waiting[indices].any():
+            raise RuntimeError('Cannot step environments that are still stepping')
+        for i, action in zip(indices, actions):
+            self._pipes[i].send(('step', action))
+        self._waiting[indices] = True
+
+    def step_wait(self, min_ready=None, timeout=None):
+        '''
+        Collects results of environments started with step_async
+        :param min_ready: return once this many environments are done, all pending ones if None
+        :param timeout: seconds to wait for each batch of ready workers, None to wait indefinitely
+        :return: indices of the done environments and their observations, rewards and terminals
+        '''
+        pending = list(np.flatnonzero(self._waiting))
+        min_ready = len(pending) if min_ready is None else min(min_ready, len(pending))
+        ready = []
+        while len(ready) < min_ready:
+            pipes = wait([self._pipes[i] for i in pending], timeout)
+            if not pipes:
+                break
+            for pipe in pipes:
+                i = self._pipes.index(pipe)
+                self.rewards[i], self.terminals[i] = pipe.recv()
+                self._waiting[i] = False
+                pending.remove(i)
+                ready.append(i)
+        ready = np.array(sorted(ready), dtype=np.int64)
+        return ready, self.observations[ready], self.rewards[ready], self.terminals[ready]
+
+    def close(self):
+        '''
+        Stops the workers and frees the shared observation array
+        '''
+        if self._waiting.any():
+            self.step_wait()
+        for pipe in self._pipes:
+            pipe.send(('close', None))
+        for process in self._processes:
+            process.join()
+        del self.observations
+        self._shm.close()
+        self._shm.unlink()
@@ -4,6 +4,14 @@ import time
 import numpy as np
 import random as rnd
 import math
+import functools
+from collections import namedtuple
+
+# The walls of the three rooms lie within this area, whatever the window size
+GRID_WIDTH = 600
+GRID_HEIGHT = 360
+
+GridTable = namedtuple("GridTable", ["size", "positions", "rooms", "next_cell", "blocked", "observations"])
 
 class Agent:
     def __init__(self, x_position=0, y_position=0, size=20):
@@ -87,6 +95,41 @@ class Agent:
         pygame.draw.rect(surface, color, rect)
 
 
+@functools.lru_cache(maxsize=None)
+def build_transition_table(size=20):
+    '''
+    Moves an agent from every cell of the grid with every action once, so that stepping becomes table
+    lookups. Cell (i, j) at position (i * size, j * size) has index i * (GRID_HEIGHT // size) + j. The
+    tables are shared between environments and read-only.
+    :return: GridTable with positions (cells, 2) and active rooms (cells,) of the cells, the next cell
+        (cells, 4) and whether the move was blocked by a wall (cells, 4) per cell and action, and the
+        observation of arriving in a cell per desired room 1-3, shape (cells, 3, 4)
+    '''
+    num_x, num_y = GRID_WIDTH // size, GRID_HEIGHT // size
+    positions = np.stack(np.meshgrid(np.arange(num_x) * size, np.arange(num_y) * size, indexing='ij'), -1)
+    positions = positions.reshape(-1, 2)
+    rooms = np.zeros(len(positions), dtype=np.int64)
+    next_cell = np.zeros((len(positions), 4), dtype=np.int64)
+    blocked = np.zeros((len(positions), 4), dtype=bool)
+    # the environment's own update decides every move, so the tables cannot disagree with it
+    env = Environment(size)
+    for cell, (x, y) in enumerate(positions.tolist()):
+        for action in range(4):
+            env.agent.x_position, env.agent.y_position = x, y
+            env.agent.move_x(0)  # sets the active room of the cell
+            rooms[cell] = env.agent.active_room
+            new_x, new_y = env.update(action)
+            next_cell[cell, action] = (new_x // size) * num_y + new_y // size
+            blocked[cell, action] = (new_x, new_y) == (x, y)
+    observations = np.zeros((len(positions), 3, 4), dtype=np.int64)
+    observations[:, :, :2] = positions[:, np.newaxis]
+    observations[:, :, 2] = rooms[:, np.newaxis]
+    observations[:, :, 3] = np.arange(1, 4)
+    for array in (positions, rooms, next_cell, blocked, observations):
+        array.flags.writeable = False
+    return GridTable(size, positions, rooms, next_cell, blocked, observations)
+
+
 class Action_Space:
     def __init__(self):
         self.n = 4
@@ -99,7 +142,9 @@ class Observation_Space:
 class Environment:
 
 
-    def __init__(self, size=20, width=800, height=600):
+    def __init__(self, size=20, width=800, height=600, seed=None, compiled=False):
+        # compiled: step with the precomputed tables of build_transition_table. The observations are
+        # then read-only rows of a shared table instead of new arrays.
         self._running = True
         self.size = size
         self.agent = Agent(0, 0, self.size)
@@ -110,6 +155,19 @@ class Environment:
         self.action_space = Action_Space()
         self.observation_space = Observation_Space()
         self.steps = 0
+        self.table = build_transition_table(size) if compiled else None
+        if compiled:
+            # plain lists and prebuilt row views, indexing them is cheaper than indexing arrays with scalars
+            self._next_cell = self.table.next_cell.tolist()
+            self._cells = [(x, y, room) for (x, y), room in zip(self.table.positions.tolist(), self.table.rooms.tolist())]
+            self._observations = [list(rows) for rows in self.table.observations]
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        # own random state for the desired room, the global random module if seed is None
+        self.random = rnd if seed is None else rnd.Random(seed)
+        self.np_random = np.random if seed is None else np.random.RandomState(seed)
+        return [seed]
 
     def init(self):
         pygame.init()
@@ -171,18 +229,47 @@ class Environment:
 
     def step(self, action):
         self.steps = self.steps + 1
-        new_x, new_y = self.update(action)
-        new_state = np.array([new_x, new_y, self.agent.active_room, self.desired_room])
+        if self.table is not None:
+            new_state = self._step_compiled(action)
+        else:
+            new_x, new_y = self.update(action)
+            new_state = np.array([new_x, new_y, self.agent.active_room, self.desired_room])
         if self.desired_room == self.agent.active_room:
             reward = 1
-            if rnd.random() > 0.98:
-                self.desired_room = rnd.randint(1, 3)
+            if self.random.random() > 0.98:
+                self.desired_room = self.random.randint(1, 3)
                 print('New room!!!')
         else:
             reward = -1
 
         return new_state, reward, (self.steps==200), None
 
+    def _step_compiled(self, action):
+        agent = self.agent
+        cell = (agent.x_position // self.size) * (GRID_HEIGHT // self.size) + agent.y_position // self.size
+        cell = self._next_cell[cell][action]
+        # keep the agent in sync for rendering
+        agent.x_position, agent.y_position, agent.active_room = self._cells[cell]
+        return self._observations[cell][self.desired_room - 1]
+
+    def step_many(self, states, actions):
+        '''
+        Steps many independent grid worlds at once with lookups in the transition table
+        :param states: observations of shape (N, 4) as returned by step
+        :param actions: actions of shape (N,)
+        :return: next observations (N, 4) and rewards (N,). Unlike step, a change of the desired room
+            already shows in the returned observation, as the states carry it to the next call.
+        '''
+        table = self.table if self.table is not None else build_transition_table(self.size)
+        states = np.asarray(states)
+        cells = (states[:, 0] // self.size) * (GRID_HEIGHT // self.size) + states[:, 1] // self.size
+        cells = table.next_cell[cells, np.asarray(actions)]
+        desired = states[:, 3].copy()
+        rewards = np.where(table.rooms[cells] == desired, 1, -1)
+        change = (rewards == 1) & (self.np_random.uniform(size=len(states)) > 0.98)
+        desired[change] = self.np_random.randint(1, 4, size=np.count_nonzero(change))
+        return table.observations[cells, desired - 1], rewards
+
 
     def execute(self):
         if self.init() == False:
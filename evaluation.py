@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+
+def _num_envs(envs):
+    return len(envs) if isinstance(envs, (list, tuple)) else envs.num_envs
+
+
+def _reset(envs, indices):
+    if isinstance(envs, (list, tuple)):
+        return np.stack([np.asarray(envs[i].reset()) for i in indices])
+    return envs.reset(indices)
+
+
+def _step(envs, actions, indices):
+    '''
+    Steps the environments in indices
+    :return: their observations, rewards and terminals
+    '''
+    if isinstance(envs, (list, tuple)):
+        results = [envs[i].step(action) for i, action in zip(indices, actions)]
+        return (np.stack([np.asarray(result[0]) for result in results]),
+                np.array([result[1] for result in results], dtype=np.float64),
+                np.array([result[2] for result in results], dtype=bool))
+    if hasattr(envs, 'step_async'):
+        # EnvPool: only the workers with a running episode are stepped
+        envs.step_async(actions, indices)
+        _, observations, rewards, terminals = envs.step_wait()
+        return observations, rewards, terminals
+    # VectorRoom steps all rooms, the idle ones are ignored
+    all_actions = np.zeros(envs.num_envs, dtype=np.int64)
+    all_actions[indices] = actions
+    observations, rewards, terminals, _ = envs.step(all_actions)
+    return observations[indices], rewards[indices], terminals[indices]
+
+
+def evaluate(model, envs, num_episodes, eps=0., max_steps=200, preprocess=None, seed=None,
+             percentiles=(5, 25, 50, 75, 95)):
+    '''
+    Runs greedy, or epsilon-greedy, episodes of a model on a pool of environments. The Q-values of all
+    environments with a running episode are computed in one forward pass per step. Episode k runs in
+    environment k % N, so a pool of seeded rooms, e.g. [Room(headless=True, seed=i) for i in range(N)],
+    plays the same layouts for every model it evaluates.
+    :param model: DoubleQLearningModel, e.g. restored with load or Checkpointer.load
+    :param envs: a list of environments, an EnvPool or a VectorRoom, built with the renderer, collision
+        test and observation of the training environment. VectorRoom draws the car as a solid footprint
+        and tests collisions analytically, so it only matches Room(renderer='numpy', collision='analytic').
+    :param num_episodes: number of episodes in total
+    :param eps: probability of taking a uniform random action
+    :param max_steps: episodes that have not reached the goal after this many steps end unsuccessful
+    :param preprocess: applied to batches of observations, None to halve them as in training
+    :param seed: seed of the exploration, which never touches np.random
+    :param percentiles: percentiles of the returns and episode lengths to report
+    :return: dict with the mean, standard deviation and percentiles of the returns and episode lengths,
+        the success rate, the throughput and the returns, lengths and successes of all episodes
+    '''
+    if num_episodes < 1:
+        raise ValueError('num_episodes must be at least 1, not %r' % (num_episodes,))
+    if preprocess is None:
+        preprocess = lambda observations: np.asarray(observations) / 2
+    n = _num_envs(envs)
+    num_actions = (envs[0] if isinstance(envs, (list, tuple)) else envs).action_space.n
+    random_state = np.random.RandomState(seed)
+    remaining = np.bincount(np.arange(num_episodes) % n, minlength=n)
+    active = np.flatnonzero(remaining)
+    remaining[active] -= 1
+
+    first = preprocess(_reset(envs, active))
+    states = np.zeros((n,) + first.shape[1:], dtype=first.dtype)
+    states[active] = first
+    ep_rewards = np.zeros(n)
+    steps = np.zeros(n, dtype=int)
+    returns, lengths, successes = [], [], []
+    total_steps = 0
+    start = time.perf_counter()
+    while len(active) > 0:
+        actions = np.argmax(model.get_q_values(states[active]), axis=1)
+        if eps > 0:
+            explore = random_state.uniform(size=len(active)) < eps
+            actions[explore] = random_state.randint(num_actions, size=np.count_nonzero(explore))
+        observations, rewards, terminals = _step(envs, actions, active)
+        states[active] = preprocess(observations)
+        ep_rewards[active] += rewards
+        steps[active] += 1
+        total_steps += len(active)
+
+        done = terminals | (steps[active] >= max_steps)
+        for i, success in zip(active[done], terminals[done]):
+            returns.append(ep_rewards[i])
+            lengths.append(steps[i])
+            successes.append(bool(success))
+        restart = active[done][remaining[active[done]] > 0]
+        active = active[~done]
+        if len(restart) > 0:
+            remaining[restart] -= 1
+            states[restart] = preprocess(_reset(envs, restart))
+            ep_rewards[restart] = 0
+            steps[restart] = 0
+            active = np.sort(np.concatenate([active, restart]))
+    elapsed = time.perf_counter() - start
+
+    returns = np.array(returns)
+    lengths = np.array(lengths)
+    results = {'episodes': len(returns), 'mean_return': float(returns.mean()), 'std_return': float(returns.std()),
+               'success_rate': float(np.mean(successes)), 'mean_length': float(lengths.mean()),
+               'steps': total_steps, 'seconds': elapsed, 'steps_per_s': total_steps / max(elapsed, 1e-9)}
+    for p, ret, length in zip(percentiles, np.percentile(returns, percentiles), np.percentile(lengths, percentiles)):
+        results['return_p%g' % p] = float(ret)
+        results['length_p%g' % p] = float(length)
+    results.update(returns=returns.tolist(), lengths=lengths.tolist(), successes=successes)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Greedy evaluation of a model saved with DoubleQLearningModel.save_model')
+    parser.add_argument('directory', nargs='?', default='models', help='directory the model was saved to')
+    parser.add_argument('--episodes', type=int, default=100)
+    parser.add_argument('--envs', type=int, default=16, help='number of rooms stepped together')
+    parser.add_argument('--pool', action='store_true', help='step the rooms in worker processes with an EnvPool')
+    parser.add_argument('--eps', type=float, default=0.)
+    parser.add_argument('--max-steps', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the room layouts and the exploration')
+    # the defaults are the settings of Room(), the training environment in main.py
+    parser.add_argument('--renderer', default='pygame', choices=['pygame', 'numpy'])
+    parser.add_argument('--collision', default='sprite', choices=['sprite', 'analytic'])
+    parser.add_argument('--observation', default='image', choices=['image', 'state'])
+    parser.add_argument('--num-rays', type=int, default=0, help='rays of state observations')
+    parser.add_argument('--frame-size', type=int, help='preprocess the frames to this size, as FramePreprocessor')
+    parser.add_argument('--output', help='file the results are written to as JSON')
+    args = parser.parse_args()
+
+    # run without a window unless a video driver is picked explicitly, before pygame is imported
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import functools
+    from dqn_model import DoubleQLearningModel
+    from env_pool import EnvPool
+    from preprocessing import FramePreprocessor
+    from room import Room
+    env_fns = [functools.partial(Room, headless=True, renderer=args.renderer, collision=args.collision,
+                                 observation=args.observation, num_rays=args.num_rays, seed=args.seed + i)
+               for i in range(args.envs)]
+    envs = EnvPool(env_fns) if args.pool else [env_fn() for env_fn in env_fns]
+    preprocess = None
+    if args.observation == 'state':
+        preprocess = np.asarray
+    elif args.frame_size is not None:
+        preprocess = FramePreprocessor(output_size=(args.frame_size, args.frame_size))
+    model = DoubleQLearningModel.from_env(envs if args.pool else envs[0], preprocess=preprocess)
+    model.load(args.directory)
+
+    results = evaluate(model, envs, args.episodes, args.eps, args.max_steps, preprocess, args.seed)
+    if args.pool:
+        envs.close()
+    for key, value in results.items():
+        if not isinstance(value, list):
+            print('%-14s %g' % (key, value))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,11 +1,15 @@
 # Import dependencies
+import functools
 import numpy as np
-import gym
-from keras.utils.np_utils import to_categorical as one_hot
-from collections import namedtuple
-from dqn_model import DoubleQLearningModel, ExperienceReplay
+from dqn_model import Transition, DoubleQLearningModel, ExperienceReplay, ArrayExperienceReplay, FrameExperienceReplay, \
+    MemmapExperienceReplay, PrioritizedExperienceReplay, MinibatchPrefetcher, MLPDoubleQLearningModel
 #from environment import Environment
-from room import Room
+from room import Room, VectorRoom
+from env_pool import EnvPool
+from preprocessing import FramePreprocessor, FrameStack
+from metrics import PhaseTimer, MetricsLogger, ProfileWindow
+from checkpoint import Checkpointer
+from tabular import TabularQModel
 
 
 def eps_greedy_policy(q_values, eps):
@@ -33,35 +37,93 @@ def calculate_td_targets(q1_batch, q2_batch, r_batch, t_batch, gamma=.99):
     '''
     # YOUR CODE HERE
     N = q1_batch.shape[0]
-    best_actions = np.argmax(q1_batch, axis=1).reshape(N,1) # Nx1
-    Q = np.array([q2_batch[s,a] for s,a in enumerate(best_actions)]) # Nx1
+    best_actions = np.argmax(q1_batch, axis=1) # N
+    Q = q2_batch[np.arange(N), best_actions].reshape(N, 1) # Nx1
     Y = r_batch + gamma * np.logical_not(t_batch) * Q
     return Y
 
 
-def train_loop_ddqn(model, env, num_episodes, batch_size=64, gamma=.94):
-    Transition = namedtuple("Transition", ["s", "a", "r", "next_s", "t"])
+def train_on_minibatch(model, replay_buffer, batch_size, gamma, timer=None):
+    '''
+    Samples a minibatch from the replay buffer and performs one update step on the model
+    : param model: DoubleQLearningModel
+    : param replay_buffer: replay buffer to sample from, prioritized buffers get their priorities updated
+    : param batch_size: number of transitions in the minibatch
+    : param gamma: discount factor
+    : param timer: optional PhaseTimer that gets the sample, td_target, update and weight_sync phases
+    '''
+    batch = replay_buffer.sample_minibatch(batch_size)  # sample a minibatch of transitions
+    if timer is not None:
+        timer.lap('sample')
+    s, a, r, s_, t = batch[:5]
+    q_1, q_2 = model.get_q_values_for_both_models(s_)
+    td_target = calculate_td_targets(q_1, q_2, r, t, gamma)
+    if timer is not None:
+        timer.lap('td_target')
+    if len(batch) > 5:
+        # prioritized buffers also return ids and importance-sampling weights: weight the loss by them
+        # and reprioritize with the TD errors
+        ids, weights = batch[5:]
+        td_error = model.update(s, td_target, a, weights, sync_target=False)
+        replay_buffer.update_priorities(ids, td_error)
+    else:
+        model.update(s, td_target, a, sync_target=False)
+    if timer is not None:
+        timer.lap('update')
+    model.update_target()
+    if timer is not None:
+        timer.lap('weight_sync')
+
+
+def train_loop_ddqn(model, env, num_episodes, batch_size=64, gamma=.94, preprocess=None, step_budget=None,
+                    metrics=None, log_every=100, profile=None, checkpointer=None):
+    '''
+    Trains the model on the environment with epsilon-greedy exploration
+    : param preprocess: FramePreprocessor applied to the observations, None to only halve them
+    : param step_budget: stop after this many environment steps in total, None to only stop after num_episodes
+    : param metrics: optional MetricsLogger that gets the wall time per phase, steps/sec and replay fill level
+        every log_every steps
+    : param profile: optional ProfileWindow that profiles a window of steps
+    : param checkpointer: optional Checkpointer, training resumes from its checkpoint and a new one is
+        written every checkpointer.every episodes
+    '''
     eps = 1.
     eps_end = .1
     eps_decay = .001
     R_buffer = []
     R_avg = []
-    for i in range(num_episodes):
+    total_steps = 0
+    first_episode = 0
+    training = checkpointer.load(model, replay_buffer, env) if checkpointer is not None else None
+    if training is not None:
+        first_episode, eps, total_steps = training['episode'], training['eps'], training['total_steps']
+        R_buffer, R_avg = training['R_buffer'], training['R_avg']
+    timer = PhaseTimer()
+    for i in range(first_episode, num_episodes):
         state = env.reset()  # reset to initial state
-        state = np.expand_dims(state, axis=0) / 2
+        state = np.expand_dims(state, axis=0) / 2 if preprocess is None else preprocess(state)[np.newaxis]
         terminal = False  # reset terminal flag
         ep_reward = 0
         q_buffer = []
         steps = 0
+        timer.lap('reset')
         while not terminal:
+            if profile is not None:
+                profile.step(total_steps)
+                timer.lap('logging')
             env.render()  # comment this line out if you don't want to / cannot render the environment on your system
+            # Room draws its observation in step, so render only counts towards the env step
+            timer.lap('env_step')
             steps += 1
             q_values = model.get_q_values(state)
             q_buffer.append(q_values)
             policy = eps_greedy_policy(q_values.squeeze(), eps)
             action = np.random.choice(num_actions, p=policy)  # sample action from epsilon-greedy policy
+            timer.lap('action')
             new_state, reward, terminal, _ = env.step(action)  # take one step in the evironment
-            new_state = np.expand_dims(new_state, axis=0) / 2
+            timer.lap('env_step')
+            new_state = np.expand_dims(new_state, axis=0) / 2 if preprocess is None else preprocess(new_state)[np.newaxis]
+            timer.lap('preprocess')
 
             # only use the terminal flag for ending the episode and not for training
             # if the flag is set due to that the maximum amount of steps is reached 
@@ -71,13 +133,20 @@ def train_loop_ddqn(model, env, num_episodes, batch_size=64, gamma=.94):
             replay_buffer.add(Transition(s=state, a=action, r=reward, next_s=new_state, t=t_to_buffer))
             state = new_state
             ep_reward += reward
+            timer.lap('replay_add')
 
             # if buffer contains more than 1000 samples, perform one training step
             if replay_buffer.buffer_length > 1000:
-                s, a, r, s_, t = replay_buffer.sample_minibatch(batch_size)  # sample a minibatch of transitions
-                q_1, q_2 = model.get_q_values_for_both_models(np.squeeze(s_))
-                td_target = calculate_td_targets(q_1, q_2, r, t, gamma)
-                model.update(s, td_target, a)
+                train_on_minibatch(model, replay_buffer, batch_size, gamma, timer)
+
+            total_steps += 1
+            if metrics is not None and total_steps % log_every == 0:
+                record = {'step': total_steps, 'episode': i, 'eps': eps, 'replay_fill': replay_buffer.buffer_length}
+                record.update(timer.window(log_every))
+                metrics.log(record)
+            timer.lap('logging')
+            if step_budget is not None and total_steps >= step_budget:
+                return R_buffer, R_avg
 
         eps = max(eps - eps_decay, eps_end)  # decrease epsilon
         R_buffer.append(ep_reward)
@@ -85,6 +154,12 @@ def train_loop_ddqn(model, env, num_episodes, batch_size=64, gamma=.94):
         # running average of episodic rewards
         R_avg.append(.05 * R_buffer[i] + .95 * R_avg[i - 1]) if i > 0 else R_avg.append(R_buffer[i])
         print('Episode: ', i, 'Reward:', ep_reward, 'Epsilon', eps, 'mean q', np.mean(np.array(q_buffer)))
+        timer.lap('logging')
+
+        if checkpointer is not None and (i + 1) % checkpointer.every == 0:
+            checkpointer.save(model, replay_buffer, {'episode': i + 1, 'eps': eps, 'total_steps': total_steps,
+                                                     'R_buffer': R_buffer, 'R_avg': R_avg}, env)
+            timer.lap('checkpoint')
 
         # if running average > 195, the task is considerd solved
         if R_avg[-1] > 195:
@@ -92,23 +167,122 @@ def train_loop_ddqn(model, env, num_episodes, batch_size=64, gamma=.94):
     return R_buffer, R_avg
 
 
-# Create the environment
-#env = gym.make("CartPole-v0")
-#env = Environment(20, 600, 360)
-env = Room()
+def train_loop_vector_ddqn(model, env, num_episodes, batch_size=64, gamma=.94, max_steps=200, preprocess=None):
+    '''
+    Same training as train_loop_ddqn, but on a VectorRoom: the Q-values of all N rooms are computed in one
+    forward pass and one update step is performed per N environment steps.
+
+    The transitions of the N rooms are added interleaved, so FrameExperienceReplay, which stores one
+    stream of consecutive frames, cannot be used with this loop.
+    '''
+    if isinstance(getattr(replay_buffer, 'replay_buffer', replay_buffer), FrameExperienceReplay):
+        raise ValueError('FrameExperienceReplay needs the frames of one environment in order, '
+                         'use ArrayExperienceReplay with train_loop_vector_ddqn')
+    eps = 1.
+    eps_end = .1
+    eps_decay = .001
+    R_buffer = []
+    R_avg = []
+    n = env.num_envs
+    if preprocess is None:
+        preprocess = lambda observations: observations / 2
+    states = preprocess(env.reset())
+    ep_rewards = np.zeros(n)
+    steps = np.zeros(n, dtype=int)
+    while len(R_buffer) < num_episodes:
+        q_values = model.get_q_values(states)
+        # epsilon-greedy: a uniform random action with probability eps, the greedy action otherwise
+        actions = np.argmax(q_values, axis=1)
+        explore = np.random.uniform(size=n) < eps
+        actions[explore] = np.random.randint(num_actions, size=np.count_nonzero(explore))
+        new_states, rewards, terminals, _ = env.step(actions)
+        new_states = preprocess(new_states)
+        steps += 1
+        ep_rewards += rewards
+
+        for j in range(n):
+            # as in train_loop_ddqn, reaching the maximum amount of steps is not a terminal for training
+            t_to_buffer = terminals[j] if not steps[j] == max_steps else False
+            replay_buffer.add(Transition(s=states[j:j + 1], a=actions[j], r=rewards[j], next_s=new_states[j:j + 1],
+                                         t=t_to_buffer))
+        states = new_states
+
+        if replay_buffer.buffer_length > 1000:
+            train_on_minibatch(model, replay_buffer, batch_size, gamma)
+
+        done = np.flatnonzero(terminals | (steps == max_steps))
+        for j in done:
+            i = len(R_buffer)
+            eps = max(eps - eps_decay, eps_end)  # decrease epsilon
+            R_buffer.append(ep_rewards[j])
+            R_avg.append(.05 * R_buffer[i] + .95 * R_avg[i - 1]) if i > 0 else R_avg.append(R_buffer[i])
+            print('Episode: ', i, 'Reward:', ep_rewards[j], 'Epsilon', eps)
+            if R_avg[-1] > 195:
+                return R_buffer, R_avg
+        if len(done) > 0:
+            # copy first, the replay buffer may still hold views of the old rows
+            states = states.copy()
+            states[done] = preprocess(env.reset(done))
+            ep_rewards[done] = 0
+            steps[done] = 0
+    return R_buffer, R_avg
+
+
+if __name__ == "__main__":
+    # Create the environment
+    #env = gym.make("CartPole-v0")
+    #env = Environment(20, 600, 360)
+    env = Room()
+    #env = Room(headless=True)  # for machines without a display
+    #env = Room(observation='state', num_rays=8)  # feature vectors, with MLPDoubleQLearningModel and preprocess = np.asarray
+    #env = VectorRoom(16)  # train with train_loop_vector_ddqn
+    #env = EnvPool([functools.partial(Room, headless=True, renderer='numpy')] * 8)  # train with train_loop_vector_ddqn
+
+    # Optionally shrink the frames to uint8 before they reach the replay buffer and the network
+    preprocess = None
+    #preprocess = FramePreprocessor(output_size=(84, 84))
+    # or stack the last frames, the FrameStack then preprocesses every frame
+    #env = FrameStack(env, 4, FramePreprocessor(output_size=(84, 84)))
+    #preprocess = np.asarray
 
-# Initializations
-num_actions = env.action_space.n
-obs_dim = env.observation_space.shape[0]
+    # Initializations
+    num_actions = env.action_space.n
+    obs_dim = preprocess.output_shape if isinstance(preprocess, FramePreprocessor) else env.observation_space.shape[0]
+    input_scale = 1. if preprocess is None else FramePreprocessor.scale
 
-# Our Neural Network model used to estimate the Q-values
-model = DoubleQLearningModel(state_dim=obs_dim, action_dim=num_actions, learning_rate=1e-4)
+    # Our Neural Network model used to estimate the Q-values
+    model = DoubleQLearningModel(state_dim=obs_dim, action_dim=num_actions, learning_rate=1e-4,
+                                 input_scale=input_scale)
+    #model = MLPDoubleQLearningModel(state_dim=obs_dim, action_dim=num_actions, learning_rate=1e-3)  # state observations
+    # other networks, see networks.NETWORKS: network='nature_cnn' for 84x84 frames, network='dueling'
+    # or Q-tables for the grid world, Environment(20, 600, 360, compiled=True) with preprocess = np.asarray
+    #model = TabularQModel(learning_rate=.1)
 
-# Create replay buffer, where experience in form of tuples <s,a,r,s',t>, gathered from the environment is stored
-# for training
-replay_buffer = ExperienceReplay(state_size=obs_dim)
+    # Create replay buffer, where experience in form of tuples <s,a,r,s',t>, gathered from the environment is stored
+    # for training
+    replay_buffer = ExperienceReplay(state_size=obs_dim)
+    #replay_buffer = ArrayExperienceReplay(buffer_size=1e+5, state_size=obs_dim)
+    #replay_buffer = FrameExperienceReplay(buffer_size=1e+6, state_size=obs_dim)
+    #replay_buffer = FrameExperienceReplay(buffer_size=1e+6, state_size=obs_dim, palette=False)  # with preprocess
+    #replay_buffer = FrameExperienceReplay(buffer_size=1e+6, state_size=(84, 84, 1), palette=False, history=4)  # with FrameStack
+    #replay_buffer = MemmapExperienceReplay("replay", buffer_size=1e+6, state_size=obs_dim)
+    #replay_buffer = PrioritizedExperienceReplay(buffer_size=1e+5, state_size=obs_dim)
+    # optionally sample the next minibatches in a background thread, batch_size must match the one below
+    #replay_buffer = MinibatchPrefetcher(replay_buffer, batch_size=128)
 
-# Train
-num_episodes = 1200
-batch_size = 128
-R, R_avg = train_loop_ddqn(model, env, num_episodes, batch_size) #num_episodes
\ No newline at end of file
+    # Train
+    num_episodes = 1200
+    batch_size = 128
+    metrics = None
+    #metrics = MetricsLogger('metrics.csv')  # phase timings every 100 steps, the latest also in metrics.records
+    profile = None
+    checkpointer = None
+    # resumes from checkpoints/ if it holds a checkpoint, needs one of the array or frame replay buffers above
+    #checkpointer = Checkpointer('checkpoints', every=10)
+    #profile = ProfileWindow(2000, 500, 'train.prof')  # cProfile of 500 steps once training has started
+    R, R_avg = train_loop_ddqn(model, env, num_episodes, batch_size, preprocess=preprocess, metrics=metrics,
+                               profile=profile, checkpointer=checkpointer) #num_episodes
+    # greedy score on 100 episodes of 16 seeded rooms, the same layouts for every model, see evaluation.py.
+    # Build the rooms with the same settings as env above, only headless.
+    #from evaluation import evaluate
+    #print(evaluate(model, [Room(headless=True, seed=i) for i in range(16)], 100, preprocess=preprocess))
@@ -0,0 +1,129 @@
+import cProfile
+import csv
+import json
+import os
+import time
+from collections import deque
+
+# phases of a training step, in the order train_loop_ddqn runs them. Rendering is not a phase of its own,
+# Room draws its observation in step. logging covers the profiler, the metrics and the end of an episode.
+PHASES = ('reset', 'action', 'env_step', 'preprocess', 'replay_add', 'sample', 'td_target', 'update', 'weight_sync',
+          'logging', 'checkpoint')
+
+
+class PhaseTimer:
+    '''
+    Wall time per phase of a loop. Every call to lap charges the time since the previous lap to a phase,
+    so the cost is one perf_counter call per phase and nothing is lost between phases.
+    '''
+
+    def __init__(self, phases=PHASES):
+        self._totals = dict.fromkeys(phases, 0.)
+        self._last = self._window_start = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self._totals[phase] = self._totals.get(phase, 0.) + now - self._last
+        self._last = now
+
+    def window(self, steps):
+        '''
+        Ends the current window and starts the next one
+        :param steps: number of steps in the window
+        :return: dict with steps_per_s and the mean milliseconds per step of every phase in the window
+        '''
+        now = time.perf_counter()
+        record = {'steps_per_s': steps / max(now - self._window_start, 1e-9)}
+        for phase, total in self._totals.items():
+            record[phase + '_ms'] = 1e3 * total / steps
+            self._totals[phase] = 0.
+        self._window_start = now
+        return record
+
+
+class MetricsLogger:
+    '''
+    Keeps the last ring_size records in memory for live inspection and optionally appends them to a file,
+    as JSON lines or, for a path ending in .csv, as CSV rows with the keys of the first record as columns.
+    The file is rotated when it grows past max_bytes, the old files are kept as path.1 up to path.backups.
+    '''
+
+    def __init__(self, path=None, ring_size=1000, max_bytes=10 * 2 ** 20, backups=3):
+        self.records = deque(maxlen=ring_size)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._csv = path is not None and path.endswith('.csv')
+        self._file = None
+        self._writer = None
+        self._fields = None
+
+    def _open(self):
+        self._file = open(self.path, 'a', newline='')
+        if self._csv:
+            self._writer = csv.DictWriter(self._file, self._fields, extrasaction='ignore')
+            if self._file.tell() == 0:
+                self._writer.writeheader()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.replace('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def log(self, record):
+        self.records.append(record)
+        if self.path is None:
+            return
+        if self._file is None:
+            self._fields = list(record)
+            self._open()
+        if self._csv:
+            self._writer.writerow(record)
+        else:
+            self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ProfileWindow:
+    '''
+    Profiles the steps from start_step up to start_step + num_steps with cProfile and writes the stats to
+    path, to be read with pstats or snakeviz. Override _start and _stop to drive a sampling profiler instead.
+    '''
+
+    def __init__(self, start_step, num_steps, path='train.prof'):
+        self.start_step = start_step
+        self.num_steps = num_steps
+        self.path = path
+        self._profile = None
+
+    def step(self, step):
+        '''
+        Called with the number of every step before it runs
+        '''
+        if step == self.start_step:
+            self._start()
+        elif step == self.start_step + self.num_steps:
+            self._stop()
+
+    def _start(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def _stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.path)
+            self._profile = None
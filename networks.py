@@ -0,0 +1,131 @@
+import numpy as np
+
+# Keras is imported by the builders, so importing this module, or dqn_model, does not load the framework
+
+NETWORKS = {}
+
+
+def register_network(name):
+    '''
+    Decorator that registers a network builder under a name. A builder takes the state shape, the
+    number of actions, the input scale and its own keyword options and returns a Keras model.
+    '''
+    def register(builder):
+        NETWORKS[name] = builder
+        return builder
+    return register
+
+
+def default_network(state_dim):
+    '''
+    :return: 'mlp' for flat states, 'small_cnn' for frames
+    '''
+    return 'mlp' if len(state_dim) == 1 else 'small_cnn'
+
+
+def build_network(name, state_dim, action_dim, input_scale=1., **options):
+    '''
+    Builds a registered network
+    :param name: name of the network, see NETWORKS
+    :param state_dim: shape of a single state
+    :param action_dim: number of actions, one Q-value output per action
+    :param input_scale: factor the network applies to its inputs
+    :param options: options of the network's builder
+    :return: Keras model
+    '''
+    if name not in NETWORKS:
+        raise ValueError('Unknown network %r, registered networks are %s' % (name, ', '.join(sorted(NETWORKS))))
+    state_dim = tuple(state_dim) if np.iterable(state_dim) else (int(state_dim),)
+    return NETWORKS[name](state_dim, action_dim, input_scale, **options)
+
+
+def _inputs(state_dim, input_scale):
+    from keras.layers import Input, Lambda
+    inputs = Input(shape=state_dim)
+    if input_scale == 1.:
+        return inputs, inputs
+    return inputs, Lambda(lambda x, scale: x * scale, arguments={'scale': input_scale})(inputs)
+
+
+def _small_cnn_torso(x):
+    from keras.layers import Conv2D, Dense, Flatten, MaxPooling2D
+    x = Conv2D(16, (5, 5), activation='relu')(x)
+    x = MaxPooling2D(pool_size=(2, 2))(x)
+    x = Flatten()(x)
+    return Dense(16, activation='relu')(x)
+
+
+def _nature_cnn_torso(x):
+    from keras.layers import Conv2D, Dense, Flatten
+    x = Conv2D(32, (8, 8), strides=4, activation='relu')(x)
+    x = Conv2D(64, (4, 4), strides=2, activation='relu')(x)
+    x = Conv2D(64, (3, 3), strides=1, activation='relu')(x)
+    x = Flatten()(x)
+    return Dense(512, activation='relu')(x)
+
+
+def _mlp_torso(x, hidden_units=(64, 64)):
+    from keras.layers import Dense, Flatten
+    x = Flatten()(x)
+    for units in hidden_units:
+        x = Dense(units, activation='relu')(x)
+    return x
+
+
+TORSOS = {'small_cnn': _small_cnn_torso, 'nature_cnn': _nature_cnn_torso, 'mlp': _mlp_torso}
+
+
+def _dueling_q_values(streams):
+    # the Lambda is saved as bytecode, so it may not close over modules and imports what it needs
+    from keras import backend as K
+    value, advantage = streams
+    return value + advantage - K.mean(advantage, axis=1, keepdims=True)
+
+
+def _q_network(torso, state_dim, action_dim, input_scale, **options):
+    from keras.layers import Dense
+    from keras.models import Model
+    inputs, x = _inputs(state_dim, input_scale)
+    return Model(inputs, Dense(action_dim, activation='linear')(torso(x, **options)))
+
+
+@register_network('small_cnn')
+def small_cnn(state_dim, action_dim, input_scale=1.):
+    '''
+    The original network: a 5x5 convolution with 16 filters, 2x2 max pooling and 16 hidden units
+    '''
+    return _q_network(_small_cnn_torso, state_dim, action_dim, input_scale)
+
+
+@register_network('nature_cnn')
+def nature_cnn(state_dim, action_dim, input_scale=1.):
+    '''
+    The network of the Nature DQN paper, for 84x84 frames: three convolutions and 512 hidden units
+    '''
+    return _q_network(_nature_cnn_torso, state_dim, action_dim, input_scale)
+
+
+@register_network('mlp')
+def mlp(state_dim, action_dim, input_scale=1., hidden_units=(64, 64)):
+    '''
+    Fully connected layers for low-dimensional states
+    :param hidden_units: number of units of every hidden layer
+    '''
+    return _q_network(_mlp_torso, state_dim, action_dim, input_scale, hidden_units=hidden_units)
+
+
+@register_network('dueling')
+def dueling(state_dim, action_dim, input_scale=1., torso=None, **options):
+    '''
+    Dueling head, Q = V + A - mean(A), on the torso of another network
+    :param torso: 'small_cnn', 'nature_cnn' or 'mlp', by default the one default_network picks for the states
+    :param options: options of the torso, e.g. hidden_units for 'mlp'
+    '''
+    from keras.layers import Dense, Lambda
+    from keras.models import Model
+    inputs, x = _inputs(state_dim, input_scale)
+    features = TORSOS[torso or default_network(state_dim)](x, **options)
+    value = Dense(1, activation='linear')(features)
+    advantage = Dense(action_dim, activation='linear')(features)
+    q_values = Lambda(_dueling_q_values)([value, advantage])
+    return Model(inputs, q_values)
@@ -0,0 +1,150 @@
+import copy
+import numpy as np
+from room import BACKGROUND_COLOR, GOAL_COLOR, OBSTACLE_COLOR
+
+
+def pack_color(color):
+    '''
+    Packs an RGB color the way pygame.surfarray.array2d returns pixels of a 32-bit surface
+    '''
+    return (color[0] << 16) | (color[1] << 8) | color[2]
+
+
+class FramePreprocessor:
+    '''
+    Turns Room observations, packed RGB integers indexed [x, y], into small uint8 frames.
+
+    'grayscale' maps every pixel to its luma, 'occupancy' gives one channel each for obstacles, the goal
+    and the agent. Frames are shrunk by averaging the pixels of every output cell, so thin objects
+    stay visible as partially covered cells. The averaging is done as two matrix products. Scale the
+    uint8 frames by `scale` to get values in [0, 1], e.g. with
+    DoubleQLearningModel(input_scale=preprocess.scale).
+    '''
+
+    scale = 1. / 255
+
+    def __init__(self, input_size=(400, 400), output_size=(84, 84), mode='grayscale'):
+        if mode not in ('grayscale', 'occupancy'):
+            raise ValueError("mode must be 'grayscale' or 'occupancy', not %r" % (mode,))
+        if output_size[0] > input_size[0] or output_size[1] > input_size[1]:
+            raise ValueError('output_size %s is larger than input_size %s' % (output_size, input_size))
+        self.input_size = tuple(input_size)
+        self.mode = mode
+        channels = 1 if mode == 'grayscale' else 3
+        self.output_shape = (output_size[0], output_size[1], channels)
+
+        self._x_weights = self._averaging_matrix(input_size[0], output_size[0])
+        self._y_weights = self._averaging_matrix(input_size[1], output_size[1]).T
+        # luma weights of the blue, green and red bytes of a packed pixel
+        self._luma = np.array([.114, .587, .299, 0], dtype=np.float32)
+        self._background = pack_color(BACKGROUND_COLOR)
+        self._obstacle = pack_color(OBSTACLE_COLOR)
+        self._goal = pack_color(GOAL_COLOR)
+
+    @staticmethod
+    def _averaging_matrix(input_size, output_size):
+        '''
+        :return: matrix of shape (output_size, input_size) whose rows average one bin of input pixels
+        '''
+        edges = np.linspace(0, input_size, output_size + 1).astype(np.int64)
+        bins = np.repeat(np.arange(output_size), np.diff(edges))
+        weights = np.zeros((output_size, input_size), dtype=np.float32)
+        weights[bins, np.arange(input_size)] = 1. / np.diff(edges)[bins]
+        return weights
+
+    def __call__(self, frames):
+        '''
+        :param frames: a frame of shape input_size (+ (1,)) or a batch of them
+        :return: uint8 frames of shape output_shape, with the same leading batch dimensions
+        '''
+        frames = np.asarray(frames)
+        batch_shape = frames.shape[:frames.ndim - (3 if frames.shape[-1] == 1 else 2)]
+        frames = frames.reshape((-1,) + self.input_size)
+        if self.mode == 'grayscale':
+            # the bytes of a little-endian packed pixel are blue, green, red and an unused one
+            pixels = frames.astype('<i4', copy=False).view(np.uint8).reshape(frames.shape + (4,))
+            channels = [np.matmul(pixels.astype(np.float32), self._luma)]
+        else:
+            obstacles = frames == self._obstacle
+            goal = frames == self._goal
+            agent = ~(obstacles | goal | (frames == self._background))
+            channels = [mask.astype(np.float32) * np.float32(255) for mask in (obstacles, goal, agent)]
+        image = np.stack([np.matmul(np.matmul(self._x_weights, channel), self._y_weights) for channel in channels],
+                         axis=-1)
+        return np.rint(image).astype(np.uint8).reshape(batch_shape + self.output_shape)
+
+
+class FrameStack:
+    '''
+    Wraps an environment so its observations are the last k frames stacked along the last axis,
+    oldest first. After a reset the first frame fills the whole stack.
+
+    Frames live in a store of 2k slots along the last axis where every frame is written twice, so the
+    last k frames are always adjacent and an observation is a view of the store, nothing is copied per
+    step. An observation stays valid while the next one is written, so (state, new_state) pairs can be
+    added to a replay buffer, but it changes after that; copy it to keep it longer. All replay buffers
+    copy what they keep of it.
+    '''
+
+    def __init__(self, env, k, preprocess=None):
+        '''
+        :param env: environment with reset() and step(action)
+        :param k: number of stacked frames
+        :param preprocess: optional callable applied to every frame before it is stacked, e.g. a FramePreprocessor
+        '''
+        self.env = env
+        self.k = k
+        self.preprocess = preprocess
+        self.action_space = env.action_space
+        frame_shape = preprocess.output_shape if isinstance(preprocess, FramePreprocessor) \
+            else env.observation_space.shape[0]
+        frame_shape = tuple(frame_shape) if np.iterable(frame_shape) else (frame_shape,)
+        self.observation_space = copy.copy(env.observation_space)
+        self.observation_space.shape = [frame_shape[:-1] + (k * frame_shape[-1],)]
+        self._store = None
+        self._channels = None
+        self._position = 0
+
+    def _frame(self, observation):
+        return np.asarray(observation if self.preprocess is None else self.preprocess(observation))
+
+    def _slots(self, position):
+        # slots that hold the frame at a position of the k + 1 long ring, every slot s holds
+        # position (s - k + 1) mod (k + 1)
+        slots = [position + self.k - 1]
+        if position >= 2:
+            slots.append(position - 2)
+        return slots
+
+    def _push(self, frame):
+        for slot in self._slots(self._position):
+            self._store[..., slot * self._channels:(slot + 1) * self._channels] = frame
+
+    @property
+    def frame(self):
+        '''
+        The newest frame, a view of the store
+        '''
+        slot = self._position + self.k - 1
+        return self._store[..., slot * self._channels:(slot + 1) * self._channels]
+
+    def observation(self):
+        return self._store[..., self._position * self._channels:(self._position + self.k) * self._channels]
+
+    def reset(self):
+        frame = self._frame(self.env.reset())
+        if self._store is None:
+            self._channels = frame.shape[-1]
+            self._store = np.zeros(frame.shape[:-1] + (2 * self.k * self._channels,), dtype=frame.dtype)
+        self._store[...] = np.tile(frame, 2 * self.k)
+        self._position = 0
+        return self.observation()
+
+    def render(self):
+        self.env.render()
+
+    def step(self, action):
+        observation, reward, terminal, info = self.env.step(action)
+        self._position = (self._position + 1) % (self.k + 1)
+        self._push(self._frame(observation))
+        return self.observation(), reward, terminal, info
@@ -5,6 +5,14 @@ import numpy as np
 import random as rnd
 from enum import Enum
 import math
+from collections import namedtuple
+from collision import BoxSet, obb_overlaps, ray_distances, rects_to_boxes
+
+BACKGROUND_COLOR = (0, 0, 0)
+GOAL_COLOR = (255, 255, 0)
+OBSTACLE_COLOR = (100, 128, 100)
+# The pygame renderer draws the car sprite, the numpy renderer fills its footprint with this color
+AGENT_COLOR = (255, 160, 0)
 
 class Agent:
     def __init__(self):
@@ -21,6 +29,10 @@ class Agent:
         self.yaw = 0
         self.velocity = 0
 
+        # With analytic collisions the car is an oriented rectangle and the sprite is only updated when drawn
+        self.analytic = False
+        self._sprite_stale = False
+
     def move_bm(self, actions, obstacles, goal):
         # Bicycle model
         # Input to movement is steering wheel angle and the velocity of the vehicle.
@@ -70,15 +82,24 @@ class Agent:
         return goal_reached
 
     def set_pos(self):
+        if self.analytic:
+            self._sprite_stale = True
+        else:
+            self.update_sprite()
+
+    def update_sprite(self):
         self.pop.image = pygame.transform.rotate(self.pop.image_original, -math.degrees(self.yaw))
         self.pop.rect = self.pop.image.get_rect(center=(self.x, self.y))
         self.pop.mask = pygame.mask.from_surface(self.pop.image)
+        self._sprite_stale = False
 
     def draw(self, surface):
         self.set_pos()
         pygame.draw.rect(surface, self.color, self.rect)
 
     def is_colliding(self, obstacles):
+        if isinstance(obstacles, BoxSet):
+            return obstacles.overlaps(self.x, self.y, self.yaw, self.length / 2, self.width / 2)
         if pygame.sprite.spritecollideany(self.pop, obstacles, collided=None):
             collision_occurred = True
         else:
@@ -86,6 +107,8 @@ class Agent:
         return collision_occurred
 
     def is_at_goal(self, goal):
+        if isinstance(goal, BoxSet):
+            return goal.overlaps(self.x, self.y, self.yaw, self.length / 2, self.width / 2)
         if pygame.sprite.spritecollideany(self.pop, goal, collided=None):
             goal_reached = True
         else:
@@ -108,17 +131,28 @@ class Population(pygame.sprite.Sprite):
         elif "goal" in type:
             self.image = pygame.Surface(size)
             self.rect = self.image.get_rect(center=pos)
-            self.image.fill((255, 255, 0))
+            self.image.fill(GOAL_COLOR)
         elif "obstacle" in type:
             self.image = pygame.Surface(size)
             self.rect = self.image.get_rect(center=pos)
-            self.image.fill((100, 128, 100))
+            self.image.fill(OBSTACLE_COLOR)
         else:
             self.image = pygame.Surface(size)
 
         self.mask = pygame.mask.from_surface(self.image)
 
 
+# Features of Room(observation='state'), followed by the ray distances
+STATE_FEATURES = ('x', 'y', 'cos_yaw', 'sin_yaw', 'velocity', 'goal_dx', 'goal_dy')
+MAX_VELOCITY = 30
+
+# Everything setup draws for an episode. A layout is never changed after setup, so snapshots share it.
+RoomLayout = namedtuple("RoomLayout", ["goal_pop", "goal", "obstacles", "obstacle_boxes", "goal_boxes", "background"])
+
+# Snapshot of a Room as returned by Room.get_state
+RoomState = namedtuple("RoomState", ["x", "y", "yaw", "velocity", "action", "layout"])
+
+
 class ObservationSpace:
     def __init__(self):
         self.shape = [3]
@@ -130,34 +164,88 @@ class ActionSpace:
 
 
 class Room:
-    def __init__(self, size=(400, 400)):
+    def __init__(self, size=(400, 400), headless=False, renderer='pygame', collision='sprite', seed=None,
+                 observation='image', num_rays=0, ray_length=200.):
+        '''
+        :param size: width and height of the room in pixels
+        :param headless: draw into an off-screen surface and never touch the display or its event queue
+        :param renderer: 'pygame' blits the sprites and copies the surface out, 'numpy' rasterizes the
+            observation directly into an array. The numpy renderer returns the same array from every step,
+            so copy an observation if it has to outlive the next step.
+        :param collision: 'sprite' tests the car sprite's rect against the obstacle sprites, 'analytic' tests
+            the car as an oriented rectangle against the obstacle boxes without touching the sprites
+        :param seed: seed of the room's own random state that draws the layouts, None to draw them from np.random
+        :param observation: 'image' observes the rendered frame, 'state' a float32 vector of STATE_FEATURES:
+            position and goal offset divided by the room size, the heading as cos and sin and the velocity
+            divided by its maximum. A headless room with state observations is never drawn.
+        :param num_rays: number of rays, evenly spaced around the agent's heading, whose distances to the
+            nearest obstacle are appended to state observations, divided by ray_length
+        :param ray_length: range of the rays in pixels
+        '''
+        if renderer not in ('pygame', 'numpy'):
+            raise ValueError("renderer must be 'pygame' or 'numpy', not %r" % (renderer,))
+        if collision not in ('sprite', 'analytic'):
+            raise ValueError("collision must be 'sprite' or 'analytic', not %r" % (collision,))
+        if observation not in ('image', 'state'):
+            raise ValueError("observation must be 'image' or 'state', not %r" % (observation,))
         self.agent = None
         self.goal_pop = None
         self.goal = None
         self.action_space = ActionSpace()
         self.observation_space = ObservationSpace()
         self.observation_space.shape = [(400, 400, 1)]
+        if observation == 'state':
+            self.observation_space.shape = [(len(STATE_FEATURES) + num_rays,)]
         self.obstacles = None
         self.size = size
+        self.observation = observation
+        self.num_rays = num_rays
+        self.ray_length = ray_length
+        self._ray_angles = 2 * np.pi * np.arange(num_rays) / max(num_rays, 1)
 
         self.action = [0, 0]
 
-        pygame.init()
-        self._display_surf = pygame.display.set_mode(
-            (self.size[0], self.size[1]), pygame.HWSURFACE)
-        pygame.display.set_caption('The agents environment')
+        self.headless = headless
+        if headless:
+            self._display_surf = pygame.Surface((self.size[0], self.size[1]), 0, 32)
+        else:
+            pygame.init()
+            self._display_surf = pygame.display.set_mode(
+                (self.size[0], self.size[1]), pygame.HWSURFACE)
+            pygame.display.set_caption('The agents environment')
         self._running = True
 
+        self.renderer = renderer
+        self.collision = collision
+        self._obstacle_boxes = None
+        self._goal_boxes = None
+        self._background = None
+        self._frame = np.zeros((self.size[0], self.size[1]), dtype=np.int32)
+        self._footprint_dx = None
+        self._footprint_dy = None
+        self._layout = None
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        '''
+        Seeds the random state that draws the layouts
+        :param seed: seed, None to use the global np.random state
+        '''
+        self.np_random = np.random if seed is None else np.random.RandomState(seed)
+        return [seed]
+
     def setup(self):
         size = self.size
         self.agent = Agent()
+        # a new episode starts with the wheels straight and no acceleration, like VectorRoom.reset
+        self.action = [0, 0]
         self.goal_pop = None
         while self.goal_pop is None or self.agent.pop.rect.colliderect(self.goal_pop.rect) != 0:
-            self.goal_pop = Population("goal", (10, 10), np.random.randint(size[0], size=(1, 2))[0])
+            self.goal_pop = Population("goal", (10, 10), self.np_random.randint(size[0], size=(1, 2))[0])
         self.goal = pygame.sprite.Group()
         self.goal.add(self.goal_pop)
         self.obstacles = pygame.sprite.Group()
-        for obs in np.random.randint(size[0], size=(20, 3)):
+        for obs in self.np_random.randint(size[0], size=(20, 3)):
             obstacle = None
             while obstacle is None or \
                     (self.agent.pop.rect.colliderect(obstacle.rect) != 0 and
@@ -174,6 +262,50 @@ class Room:
         bottom_wall = Population("obstacle", (size[0], 10), (size[0] / 2, size[0]))
         self.obstacles.add(bottom_wall)
 
+        if self.collision == 'analytic' or self.num_rays > 0:
+            # the rays are cast against the same boxes
+            self._obstacle_boxes = BoxSet.from_rects(obstacle.rect for obstacle in self.obstacles)
+            self._goal_boxes = BoxSet.from_rects([self.goal_pop.rect])
+        if self.collision == 'analytic':
+            self.agent.analytic = True
+
+        if self.renderer == 'numpy':
+            self._background = np.full(self._frame.shape, self._display_surf.map_rgb(BACKGROUND_COLOR), dtype=np.int32)
+            obstacle_color = self._display_surf.map_rgb(OBSTACLE_COLOR)
+            for obstacle in self.obstacles:
+                self._fill_rect(self._background, obstacle.rect, obstacle_color)
+            # Pixel offsets around the agent that can be covered by its footprint at any yaw
+            reach = int(math.ceil(math.hypot(self.agent.width, self.agent.length) / 2)) + 1
+            offsets = np.arange(-reach, reach + 1)
+            self._footprint_dx, self._footprint_dy = np.meshgrid(offsets, offsets, indexing='ij')
+
+        self._layout = RoomLayout(self.goal_pop, self.goal, self.obstacles, self._obstacle_boxes, self._goal_boxes,
+                                  self._background)
+
+    def get_state(self):
+        '''
+        Snapshot of the episode: the agent's pose and velocity, the current action and the layout. The layout
+        is shared with the room, not copied, so a snapshot is cheap enough to take every step.
+        :return: RoomState
+        '''
+        agent = self.agent
+        return RoomState(agent.x, agent.y, agent.yaw, agent.velocity, tuple(self.action), self._layout)
+
+    def set_state(self, state):
+        '''
+        Puts the room back into a snapshot from get_state of this room or of one with the same settings.
+        The next step continues from it, the observation is drawn by that step.
+        :param state: RoomState
+        '''
+        if state.layout is not self._layout:
+            self._layout = state.layout
+            self.goal_pop, self.goal, self.obstacles, self._obstacle_boxes, self._goal_boxes, self._background = \
+                state.layout
+        agent = self.agent
+        agent.x, agent.y, agent.yaw, agent.velocity = state.x, state.y, state.yaw, state.velocity
+        self.action = list(state.action)
+        agent.set_pos()
+
     def reward(self):
         x1, y1 = self.agent.x, self.agent.y
         x2, y2 = self.goal_pop.rect.center[0], self.goal_pop.rect.center[1]
@@ -189,7 +321,8 @@ class Room:
         pass
 
     def step(self, action_index):
-        pygame.event.pump()
+        if not self.headless:
+            pygame.event.pump()
 
         # Index 0-2 concerns steer wheel angle.
         # Index 3-5 concerns acceleration.
@@ -206,14 +339,71 @@ class Room:
         elif action_index == 5:
             self.action[1] = -1
 
-        terminal = self.agent.move_bm(self.action, self.obstacles, self.goal)
-        self._render()
-        image_state = pygame.surfarray.array2d(self._display_surf).reshape((400,400,1))
+        terminal = self.agent.move_bm(self.action, *self._colliders())
+        if self.observation == 'state':
+            if not self.headless:
+                self._render()
+            return self._state_observation(), self.reward(), terminal, None
+        if self.renderer == 'numpy':
+            image_state = self._rasterize().reshape((self.size[0], self.size[1], 1))
+            if not self.headless:
+                self._render()
+        else:
+            self._render()
+            image_state = pygame.surfarray.array2d(self._display_surf).reshape((400,400,1))
         return image_state, self.reward(), terminal, None
 
+    def _state_observation(self):
+        agent = self.agent
+        width, height = self.size
+        goal_x, goal_y = self.goal_pop.rect.center
+        features = [agent.x / width, agent.y / height, math.cos(agent.yaw), math.sin(agent.yaw),
+                    agent.velocity / MAX_VELOCITY, (goal_x - agent.x) / width, (goal_y - agent.y) / height]
+        observation = np.empty(len(features) + self.num_rays, dtype=np.float32)
+        observation[:len(features)] = features
+        if self.num_rays > 0:
+            observation[len(features):] = ray_distances(agent.x, agent.y, agent.yaw + self._ray_angles,
+                                                        self._obstacle_boxes.boxes, self.ray_length) / self.ray_length
+        return observation
+
+    def _colliders(self):
+        if self.collision == 'analytic':
+            return self._obstacle_boxes, self._goal_boxes
+        return self.obstacles, self.goal
+
+    @staticmethod
+    def _fill_rect(image, rect, color):
+        # image is indexed [x, y] like pygame.surfarray
+        image[max(rect.left, 0):max(rect.right, 0), max(rect.top, 0):max(rect.bottom, 0)] = color
+
+    def _rasterize(self, frame=None):
+        '''
+        Draws the observation into the reused frame array: the cached obstacle image, the goal and the
+        agent's rotated footprint
+        :param frame: array to draw into instead of the reused frame
+        :return: frame indexed [x, y] with the same packed pixel values as the pygame surface
+        '''
+        frame = self._frame if frame is None else frame
+        np.copyto(frame, self._background)
+        self._fill_rect(frame, self.goal_pop.rect, self._display_surf.map_rgb(GOAL_COLOR))
+
+        agent = self.agent
+        x0, y0 = int(math.floor(agent.x)), int(math.floor(agent.y))
+        # Footprint test on pixel centers in the car's frame of reference
+        dx = self._footprint_dx + (x0 + .5 - agent.x)
+        dy = self._footprint_dy + (y0 + .5 - agent.y)
+        cos_yaw, sin_yaw = math.cos(agent.yaw), math.sin(agent.yaw)
+        inside = (np.abs(dx * cos_yaw + dy * sin_yaw) <= agent.length / 2) & \
+                 (np.abs(dy * cos_yaw - dx * sin_yaw) <= agent.width / 2)
+        xs = self._footprint_dx[inside] + x0
+        ys = self._footprint_dy[inside] + y0
+        on_screen = (xs >= 0) & (xs < frame.shape[0]) & (ys >= 0) & (ys < frame.shape[1])
+        frame[xs[on_screen], ys[on_screen]] = self._display_surf.map_rgb(AGENT_COLOR)
+        return frame
+
     def _render(self):
         # Render background
-        self._display_surf.fill((0, 0, 0))
+        self._display_surf.fill(BACKGROUND_COLOR)
 
         # Render obstacles
         self.obstacles.draw(self._display_surf)
@@ -222,8 +412,11 @@ class Room:
         self.goal.draw(self._display_surf)
 
         # Render agent
+        if self.agent._sprite_stale:
+            self.agent.update_sprite()
         self._display_surf.blit(self.agent.pop.image, self.agent.pop.rect)
-        pygame.display.flip()
+        if not self.headless:
+            pygame.display.flip()
 
     def cleanup(self):
         pygame.quit()
@@ -254,7 +447,7 @@ class Room:
                     if event.key == pygame.K_ESCAPE:
                         self._running = False
 
-            goal_reached = self.agent.move_bm(self.action, self.obstacles, self.goal)
+            goal_reached = self.agent.move_bm(self.action, *self._colliders())
             if goal_reached:
                 print("Goal is reached!")
 
@@ -265,6 +458,108 @@ class Room:
         self.cleanup()
 
 
+class VectorRoom:
+    '''
+    N independent rooms stepped together. The agents' poses are kept in arrays and advanced with the
+    same bicycle model as Agent.move_bm, one NumPy operation per state variable for all rooms.
+
+    Each room is drawn by a headless Room with the numpy renderer, which also generates its layout.
+    Collisions use the same oriented-rectangle test as Room(collision='analytic'), for all rooms at once.
+    Rooms whose episode ended are not reset automatically, call reset(indices) for them.
+    '''
+
+    def __init__(self, num_envs, size=(400, 400), seed=None):
+        '''
+        :param seed: room i is seeded with seed + i, None to draw all layouts from np.random
+        '''
+        self.num_envs = num_envs
+        self.size = size
+        self.rooms = [Room(size, headless=True, renderer='numpy', seed=None if seed is None else seed + i)
+                      for i in range(num_envs)]
+        self.action_space = ActionSpace()
+        self.observation_space = ObservationSpace()
+        self.observation_space.shape = [(size[0], size[1], 1)]
+
+        self.x = np.zeros(num_envs)
+        self.y = np.zeros(num_envs)
+        self.yaw = np.zeros(num_envs)
+        self.velocity = np.zeros(num_envs)
+        self.steer_wheel_angle = np.zeros(num_envs)
+        self.acceleration = np.zeros(num_envs)
+        self.width = self.length = self.length_rear = self.length_front = self.sampleTime = None
+
+        self._obstacles = None  # obstacle boxes of every room, shape (N, M, 4)
+        self._goals = np.zeros((num_envs, 1, 4))
+        self._goal_centers = np.zeros((num_envs, 2))
+        self._frames = np.zeros((num_envs, size[0], size[1], 1), dtype=np.int32)
+
+    def reset(self, indices=None):
+        '''
+        Draws new layouts for the given rooms and puts their agents at the start pose
+        :param indices: rooms to reset, all rooms if None
+        :return: observations of the reset rooms, shape (len(indices), width, height, 1)
+        '''
+        indices = np.arange(self.num_envs) if indices is None else np.asarray(indices)
+        for i in indices:
+            room = self.rooms[i]
+            room.setup()
+            agent = room.agent
+            self.width, self.length = agent.width, agent.length
+            self.length_rear, self.length_front = agent.length_rear, agent.length_front
+            self.sampleTime = agent.sampleTime
+            boxes = rects_to_boxes(obstacle.rect for obstacle in room.obstacles)
+            if self._obstacles is None:
+                self._obstacles = np.zeros((self.num_envs,) + boxes.shape)
+            self._obstacles[i] = boxes
+            self._goals[i] = rects_to_boxes([room.goal_pop.rect])
+            self._goal_centers[i] = room.goal_pop.rect.center
+            self.x[i], self.y[i], self.yaw[i], self.velocity[i] = agent.x, agent.y, agent.yaw, agent.velocity
+        self.steer_wheel_angle[indices] = 0
+        self.acceleration[indices] = 0
+        self._draw(indices)
+        return self._frames[indices]
+
+    def render(self):
+        pass
+
+    def step(self, actions):
+        '''
+        Applies one action per room
+        :param actions: action indices, shape (N,)
+        :return: observations (N, width, height, 1), rewards (N,), terminals (N,), None. The observation
+            array is reused by the next step.
+        '''
+        actions = np.asarray(actions)
+        # Index 0-2 concerns steer wheel angle, index 3-5 concerns acceleration, the other one is kept.
+        steer = actions < 3
+        self.steer_wheel_angle[steer] = np.array([0, 45, -45])[actions[steer]]
+        self.acceleration[~steer] = np.array([0, 1, -1])[actions[~steer] - 3]
+
+        truncate_value = 30
+        steer_wheel_angle = np.radians(np.clip(self.steer_wheel_angle, -truncate_value, truncate_value))
+        velocity_angle = np.arctan(self.length_rear * np.tan(steer_wheel_angle) / (self.length_rear + self.length_front))
+        x = self.x + self.sampleTime * self.velocity * np.cos(velocity_angle + self.yaw)
+        y = self.y + self.sampleTime * self.velocity * np.sin(velocity_angle + self.yaw)
+        yaw = self.yaw + self.sampleTime * self.velocity * np.sin(velocity_angle) / self.length_rear
+        self.velocity = np.clip(self.velocity + self.sampleTime * self.acceleration, -truncate_value, truncate_value)
+
+        # Keep the old pose where the new one collides
+        half_length, half_width = self.length / 2, self.width / 2
+        moved = ~obb_overlaps(x, y, yaw, half_length, half_width, self._obstacles).any(axis=1)
+        self.x[moved], self.y[moved], self.yaw[moved] = x[moved], y[moved], yaw[moved]
+
+        terminals = obb_overlaps(self.x, self.y, self.yaw, half_length, half_width, self._goals).any(axis=1)
+        rewards = -np.hypot(self.x - self._goal_centers[:, 0], self.y - self._goal_centers[:, 1])
+        self._draw(range(self.num_envs))
+        return self._frames, rewards, terminals, None
+
+    def _draw(self, indices):
+        for i in indices:
+            agent = self.rooms[i].agent
+            agent.x, agent.y, agent.yaw = self.x[i], self.y[i], self.yaw[i]
+            self.rooms[i]._rasterize(self._frames[i, :, :, 0])
+
+
 if __name__ == "__main__":
     room = Room()
     room.execute()
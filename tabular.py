@@ -0,0 +1,141 @@
+import numpy as np
+from environment import GRID_HEIGHT, build_transition_table
+
+# Environment.step draws a new desired room with this probability after a step in the desired room
+DESIRED_ROOM_CHANGE = .02
+
+
+def state_index(states, size=20):
+    '''
+    Maps grid world observations to rows of a Q-table, one per cell and desired room. The active room
+    is left out since it follows from the cell.
+    :param states: observations of shape (..., 4) as returned by Environment.step
+    :return: indices of shape (N,)
+    '''
+    states = np.asarray(states).reshape(-1, 4).astype(np.int64)
+    cells = (states[:, 0] // size) * (GRID_HEIGHT // size) + states[:, 1] // size
+    return cells * 3 + states[:, 3] - 1
+
+
+def value_iteration(size=20, gamma=.94, tol=1e-8, max_iterations=10000):
+    '''
+    Solves the grid world exactly on its transition table. Moves are deterministic, only the desired
+    room changes at random, as in Environment.step.
+    :param gamma: discount factor
+    :param tol: stop once no value changes more than this
+    :return: optimal Q-table of shape (cells * 3, 4) indexed by state_index, and the number of iterations
+    '''
+    table = build_transition_table(size)
+    next_cell = table.next_cell
+    # rewards[cell, desired room - 1, action]
+    rewards = np.where(table.rooms[next_cell][:, np.newaxis, :] == np.arange(1, 4)[np.newaxis, :, np.newaxis], 1., -1.)
+    values = np.zeros((len(next_cell), 3))
+    for iteration in range(1, max_iterations + 1):
+        next_values = values[next_cell]  # (cells, actions, desired rooms)
+        same_room = next_values.transpose(0, 2, 1)
+        new_room = next_values.mean(axis=2)[:, np.newaxis, :]
+        expected = np.where(rewards > 0, (1 - DESIRED_ROOM_CHANGE) * same_room + DESIRED_ROOM_CHANGE * new_room,
+                            same_room)
+        q = rewards + gamma * expected
+        new_values = q.max(axis=2)
+        converged = np.abs(new_values - values).max() < tol
+        values = new_values
+        if converged:
+            break
+    return q.reshape(-1, 4), iteration
+
+
+class TabularQModel:
+    '''
+    Double Q-learning with two NumPy Q-tables for the grid world. It acts, updates and checkpoints like
+    DoubleQLearningModel, so it can be trained with train_loop_ddqn, the replay buffers and a Checkpointer,
+    given the raw observations (preprocess=np.asarray). Like the 'swap' target update, the two tables switch
+    roles with probability .5 after every update.
+    '''
+
+    def __init__(self, size=20, learning_rate=.1, action_dim=4):
+        self.size = size
+        self._lr = learning_rate
+        num_states = len(build_transition_table(size).positions) * 3
+        self._online_table = np.zeros((num_states, action_dim))
+        self._offline_table = np.zeros((num_states, action_dim))
+
+    def get_q_values(self, state):
+        return self._online_table[state_index(state, self.size)]
+
+    def get_q_values_for_both_models(self, states):
+        ids = state_index(states, self.size)
+        return self._online_table[ids], self._offline_table[ids]
+
+    def act(self, state, eps=0.):
+        q_values = self.get_q_values(state)
+        if np.random.uniform() < eps:
+            return np.random.randint(q_values.shape[1])
+        return int(np.argmax(q_values[0]))
+
+    def update(self, states, td_target, actions, weights=None, sync_target=True):
+        '''
+        Moves the online Q-values of a batch towards their TD targets. A state-action pair that is in the
+        batch several times moves by the mean of its updates, so large batches cannot overshoot.
+        :param weights: batch of importance-sampling weights, None for uniform weights
+        :return: TD errors of the batch before the update
+        '''
+        ids = state_index(states, self.size)
+        actions = np.asarray(actions).reshape(-1)
+        td_error = np.asarray(td_target, dtype=np.float64).reshape(-1) - self._online_table[ids, actions]
+        step = self._lr * td_error if weights is None else self._lr * np.ravel(weights) * td_error
+        pairs = ids * self._online_table.shape[1] + actions
+        sums = np.bincount(pairs, step, minlength=self._online_table.size)
+        counts = np.bincount(pairs, minlength=self._online_table.size)
+        self._online_table += (sums / np.maximum(counts, 1)).reshape(self._online_table.shape)
+        if sync_target:
+            self.update_target()
+        return td_error
+
+    def get_state(self):
+        '''
+        :return: copies of both Q-tables, for checkpointing
+        '''
+        return {'online': self._online_table.copy(), 'offline': self._offline_table.copy()}
+
+    def set_state(self, state):
+        self._online_table[...] = state['online']
+        self._offline_table[...] = state['offline']
+
+    def update_target(self):
+        if np.random.uniform() > .5:
+            self._online_table, self._offline_table = self._offline_table, self._online_table
+
+    def learn(self, states, actions, rewards, next_states, gamma=.94):
+        '''
+        One vectorized Double Q-learning update from a batch of transitions, e.g. from Environment.step_many
+        :return: TD errors of the batch before the update
+        '''
+        next_ids = state_index(next_states, self.size)
+        best_actions = np.argmax(self._online_table[next_ids], axis=1)
+        td_target = rewards + gamma * self._offline_table[next_ids, best_actions]
+        return self.update(states, td_target, actions)
+
+    @property
+    def q_table(self):
+        return self._online_table
+
+
+def train_q_table(model, env, num_steps, num_envs=1024, eps=.1, gamma=.94):
+    '''
+    Trains a TabularQModel on num_envs grid worlds stepped together with env.step_many, starting from
+    the environment's start cell. The step limit of the environment does not apply, the worlds run on.
+    :param num_steps: number of batched steps
+    :return: mean reward per batched step
+    '''
+    states = np.tile(env.reset(), (num_envs, 1))
+    mean_rewards = []
+    for _ in range(num_steps):
+        actions = np.argmax(model.get_q_values(states), axis=1)
+        explore = np.random.uniform(size=num_envs) < eps
+        actions[explore] = np.random.randint(env.action_space.n, size=np.count_nonzero(explore))
+        next_states, rewards = env.step_many(states, actions)
+        model.learn(states, actions, rewards, next_states, gamma)
+        states = next_states
+        mean_rewards.append(rewards.mean())
+    return mean_rewards